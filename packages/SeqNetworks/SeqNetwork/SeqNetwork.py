@@ -1,7 +1,9 @@
+import array
 import collections
-import Levenshtein
-from SeqNetwork.bktree import BKtree
+from SeqNetwork.seqsearch import build_search_index
+from SeqNetwork.csrgraph import CSRGraph
 import math
+import numpy
 import pandas
 import multiprocessing
 import time
@@ -11,20 +13,53 @@ A class for building similarity networks between one or more strings within a se
 Based on sequence similarity, reads are clustered together into 'UMI' families. While the main purpose of this class is for deduplication of Read data, the core functions can also be used to define sequence clusters in other contexts.
 """
 
+## search index and sequence index of the dimension being searched, set before worker processes are forked
+_SEARCH_STATE = {}
+
+def _search_chunk(seqs):
+    """
+    Find edges for a chunk of sequences in a forked worker, using the index inherited from the parent
+
+    Parameters
+    ----------
+    seqs : list
+    sequences to search
+
+    Returns
+    -------
+    edges : list
+    (seq, node indexes within the search distance) for each sequence
+    """
+    searchIndex = _SEARCH_STATE["search_index"]
+    seqIndex = _SEARCH_STATE["seq_index"]
+    return [(seq, set.union(*[seqIndex[x] for x in searchIndex.find(seq)])) for seq in seqs]
+
 class SeqNetwork:
     """
     Construct a similarity network for a set of strings.       
     """
-    def __init__(self):
-        self.graph = collections.OrderedDict()
+    def __init__(self, search_backend="auto", processors=1):
+        """
+        Parameters
+        ----------
+        search_backend : str
+        neighbor search used for finding edges, one of seqsearch.SEARCH_BACKENDS
+        ("auto", "bktree", "pigeonhole", "hamming"), all return the same edges
+        processors : int
+        number of processes searching for edges
+        """
+        self.processors = processors
+        self.graph = CSRGraph(numpy.zeros(1, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int32))
         self.nodes = collections.OrderedDict()
         self.index = {}
-        self.node_sizes = {}
-        self.index_reads = {}
+        self.node_sizes = numpy.zeros(0, dtype=numpy.int64)
+        self.read_names = []
+        self.read_offsets = numpy.zeros(1, dtype=numpy.int64)
         self.dimensions = collections.OrderedDict()
         self.dimension_distances = collections.OrderedDict()
         self.edges = {}
-        self.BKtrees = {}        
+        self.search_backend = search_backend
+        self.search_indexes = {}
         self.total_dimensions = 0        
         self.total_centroids = 0
 
@@ -91,25 +126,30 @@ class SeqNetwork:
             sorted(self.nodes.items(), key = lambda x: len(x[1]), reverse=True)
         )
             
-    def build_trees(self):
+    def build_search_indexes(self):
         """
-        Build a BK tree for each dimension
+        Build a neighbor search index (see seqsearch) for each dimension
         """
         for dimName in self.dimensions:
             dimensionSeqs = set(self.dimensions[dimName].values())
-            self.BKtrees[dimName] = BKtree(iter(dimensionSeqs), Levenshtein.distance, 0)
+            self.search_indexes[dimName] = build_search_index(dimensionSeqs,
+                                                              self.dimension_distances[dimName],
+                                                              self.search_backend)
 
     def build_index(self):
         """
         Create an index to cross-reference sequences with their names
-        Additionally, store the sizes of each node in a dictionary
+        Nodes are numbered in size order, node sizes are stored in an array and the reads of node i are
+        read_names[read_offsets[i]:read_offsets[i + 1]]
         """
+        self.node_sizes = numpy.array([len(reads) for reads in self.nodes.values()], dtype=numpy.int64)
+        self.read_offsets = numpy.zeros(len(self.nodes) + 1, dtype=numpy.int64)
+        numpy.cumsum(self.node_sizes, out=self.read_offsets[1:])
+        self.read_names = [read for reads in self.nodes.values() for read in reads]
+        ## the reads are held by read_names, keep the sequences of each node only
+        self.nodes = list(self.nodes.keys())
         idx = 0
-        for node in self.nodes:            
-            self.node_sizes[idx] = len(self.nodes[node])
-            self.index[node] = idx
-            ## point from index value back to reads
-            self.index_reads[idx] = self.nodes[node]
+        for node in self.nodes:
             for seqTup in node:
                 dimName, seq = seqTup
                 if not dimName in self.index:
@@ -120,69 +160,71 @@ class SeqNetwork:
             idx += 1
         return 0
 
-    #################################
-    ## finding edges with single core
-    #################################
-    def find_edges(self):
+    def node_reads(self, idx):
         """
-        Identify all edges within a specified search distance for each dimension
+        Reads of a node
 
         Parameters
         ----------
-        search_dist : int
-        The Levenshtein edit distance allowed during the BKtree search over each dimension
+        idx : int
+        a node on the graph
+
+        Returns
+        -------
+        reads : list
+        """
+        return self.read_names[self.read_offsets[idx]:self.read_offsets[idx + 1]]
+
+    def find_edges(self):
+        """
+        Identify all edges within a specified search distance for each dimension.
+        With more than one processor, sequences are searched in chunks by forked worker processes,
+        which share the search index built in the parent process.
         """
         for dimName in self.dimensions:
             self.edges[dimName] = {}
-            tree = self.BKtrees[dimName]
+            searchIndex = self.search_indexes[dimName]
             dimensionSeqs = set(self.dimensions[dimName].values())
-            searchDist = self.dimension_distances[dimName]
+            if self.processors > 1 and len(dimensionSeqs) > 1:
+                self.edges[dimName] = self.parallel_find_edges(dimName, dimensionSeqs)
+                continue
             for seq in dimensionSeqs:
-                similarSeqs = tree.find(seq, searchDist)
-                self.edges[dimName][seq] = set.union(*[self.index[dimName][x] for x in similarSeqs]) 
-
-    ## parallel implementation
-    # def find_edges(self):
-    #     """
-    #     Identify all edges within a specified search distance for each dimension
-
-    #     Parameters
-    #     ----------
-    #     search_dist : int
-    #     The Levenshtein edit distance allowed during the BKtree search over each dimension
-    #     """
-    #     for dimName in self.dimensions:
-    #         self.edges[dimName] = {}
-    #         tree = self.BKtrees[dimName]
-    #         dimensionSeqs = set(self.dimensions[dimName].values())
-    #         searchDist = self.dimension_distances[dimName]
-    #         ##break set into chunks for threads
-    #         n = int(len(dimensionSeqs) / self.processors) + 2        
-    #         seqGroups = [list(dimensionSeqs)[i * n:(i + 1) * n] for i in range((len(dimensionSeqs) + n - 1) // n )]
-    #         with multiprocessing.Pool(processes=self.processors) as pool:
-    #             res = pool.imap_unordered( self.parallel_search_tree, ( (seqs, tree, searchDist) for seqs in seqGroups) )
-    #             edges = {}
-    #             ##store index values as edges
-    #             for item in res:
-    #                 for seq in item:
-    #                     self.edges[dimName][seq] = set.union(*[self.index[dimName][x] for x in item[seq]])
-          
-    # def parallel_search_tree(self, args):
-    #     """
-    #     Search for similar sequences in BKtree, in parallel
-    #     Parameters
-    #     ----------
-    #     args : tuple
-    #     seqs chunks, BKtree, search distance parameter, and the name of 
-        
-    #     """
-    #     (seqs, tree, searchDist) = args
-    #     res = {}
-    #     for seq in seqs:                        
-    #         similarSeqs = tree.find(seq, searchDist)
-    #         res[seq] = similarSeqs
-    #     return res
-        
+                similarSeqs = searchIndex.find(seq)
+                self.edges[dimName][seq] = set.union(*[self.index[dimName][x] for x in similarSeqs])
+
+    def parallel_find_edges(self, dimName, dimensionSeqs):
+        """
+        Search one dimension for edges with a pool of forked processes
+
+        Parameters
+        ----------
+        dimName : string
+        The name of the dimension searched
+        dimensionSeqs : set
+        unique sequences of the dimension
+
+        Returns
+        -------
+        edges : dict
+        node indexes within the search distance of each sequence
+        """
+        seqs = sorted(dimensionSeqs)
+        ##several chunks per process, to balance the load
+        n = max(len(seqs) // (self.processors * 8), 1)
+        chunks = [seqs[i:(i + n)] for i in range(0, len(seqs), n)]
+        _SEARCH_STATE["search_index"] = self.search_indexes[dimName]
+        _SEARCH_STATE["seq_index"] = self.index[dimName]
+        edges = {}
+        try:
+            with multiprocessing.get_context("fork").Pool(processes=self.processors) as pool:
+                ## imap returns chunks in order, so edges are merged deterministically
+                for chunkEdges in pool.imap(_search_chunk, chunks):
+                    for seq, seqEdges in chunkEdges:
+                        edges[seq] = seqEdges
+        finally:
+            _SEARCH_STATE.clear()
+        return edges
+
     def build_graph(self):
         """
         Construct the graph, build a plane in multi-dimensional space, connecting reads with similarities across all dimensions
@@ -190,19 +232,32 @@ class SeqNetwork:
         self.define_nodes()
         self.build_index()
         self.define_centroids()
-        self.build_trees()
+        self.build_search_indexes()
         self.find_edges()
         ## join edges across all dimensions
-        dimNames = list(self.dimensions.keys())        
-        for node in self.nodes:
-            nodeIdx = self.index[node]            
+        self.graph = CSRGraph.from_neighbor_sets(self.join_edges(), len(self.nodes))
+        ## edges are held by the graph from here on
+        self.edges = {}
+
+    def join_edges(self):
+        """
+        Intersect the edges of all dimensions for each node, in node order
+
+        Yields
+        ------
+        edges : set
+        nodes connected to the node in every dimension
+        """
+        dimNames = list(self.dimensions.keys())
+        for nodeIdx, node in enumerate(self.nodes):
             ##intersect all edges from each dimension
             all_dimensions = []
             for i in range(len(dimNames)):
-                all_dimensions.append(self.edges[dimNames[i]][node[i][1]])            
-            self.graph[nodeIdx] = set.intersection(*all_dimensions) 
+                all_dimensions.append(self.edges[dimNames[i]][node[i][1]])
+            edges = set.intersection(*all_dimensions)
             ## the node should not have an edge to itself
-            self.graph[nodeIdx] = self.graph[nodeIdx].difference(set([nodeIdx]))
+            edges.discard(nodeIdx)
+            yield edges
               
     def walk_graph(self, node, max_steps):
         """
@@ -220,7 +275,8 @@ class SeqNetwork:
         step = 0
         walked = {}
         #walked[node] = 0
-        edges = self.graph[node]
+        edges = self.graph.neighbor_list(node)
+        node_size = self.node_sizes.item(node)
         while True:
             ##limit the walking
             if step >= max_steps:
@@ -237,10 +293,10 @@ class SeqNetwork:
                 if not edge in walked:
                     walked[edge] = step
                 ##do not continue if next node is larger
-                if self.node_sizes[edge] > self.node_sizes[node]:
+                if self.node_sizes.item(edge) > node_size:
                     continue
-                for new_edge in set(self.graph[edge]).difference(edges):
-                    new_edges.add(new_edge)
+                new_edges.update(self.graph.neighbor_list(edge))
+            new_edges.difference_update(edges)
             if len(new_edges) == 0:
                 break
             else:
@@ -257,8 +313,7 @@ class SeqNetwork:
         The total number of N nodes at the maximum are centroids and are considered read events.
 
         """
-        node_weights = [self.node_sizes[x] for x in self.node_sizes]
-        node_weights = sorted(node_weights, reverse=True)
+        node_weights = sorted(self.node_sizes.tolist(), reverse=True)
         node_stats = []
         cummulative_total = 0
         total = sum(node_weights)
@@ -281,30 +336,70 @@ class SeqNetwork:
             self.total_centroids = 0 
         
             
-    def remove_edges(self, max_steps, minBiddingRatio):
+    def remove_edges(self, max_steps, minBiddingRatio, streaming=False):
         """
         Network partitioning steps.
         - Tranverses a graph comparing the weight between connected nodes (1-edit distance edges.)
         - Define Centroids as True nodes
         - remove edges between centroids
         - bid for smaller nodes (sequencing error)
+
+        Parameters
+        ----------
+        max_steps : int
+        number of edges walked from each bidding node
+        minBiddingRatio : float
+        the minimum weight of an accepted bid
+        streaming : bool
+        resolve bids while walking the graph (see best_bids), keeping the best bid of each node
+        instead of every bid. The graph is walked twice, the partitioned graph is the same.
         """
+        centroids = self.centroid_nodes()
+        if streaming:
+            bidders = self.best_bids(max_steps, minBiddingRatio, centroids)
+            for node in self.graph:
+                if bidders[node] >= 0:
+                    self.commit_bid(node, bidders[node])
+        else:
+            bids = self.collect_bids(max_steps)
+            self.accept_bids(bids, centroids, minBiddingRatio)
+        self.remove_centroid_edges(centroids)
+        ## store the partitioned graph in the arrays again
+        self.graph.compact()
 
-        ###############################
-        ## calculate weights for nodes
-        ###############################
-        bids = {}    
+    def centroid_nodes(self):
+        """
+        Centroids are the largest nodes holding more than one read, see define_centroids
+
+        Returns
+        -------
+        centroids : set
+        """
         centroids = set()
         ## nodes are sorted in order
         node_count=0
         for node in self.graph:
             node_count += 1
-            node_size = self.node_sizes[node]
-            if node_count < self.total_centroids and node_size > 1:
+            if node_count < self.total_centroids and self.node_sizes.item(node) > 1:
                 centroids.add(node)
+        return centroids
+
+    def collect_bids(self, max_steps):
+        """
+        calculate weights for nodes, every node bids for all the nodes found walking the graph
+
+        Returns
+        -------
+        bids : dict
+        all bids for each node, in the order of the bidding nodes
+        """
+        bids = {}    
+        node_sizes = self.node_sizes.tolist()
+        for node in self.graph:
+            node_size = node_sizes[node]
             walked = self.walk_graph(node, max_steps)
             for edge in walked:
-                edge_size = self.node_sizes[edge]                
+                edge_size = node_sizes[edge]                
                 steps = walked[edge]                
                 weight = (node_size**(1/steps))/edge_size
                 bid = {"bidding_node":node,
@@ -315,10 +410,12 @@ class SeqNetwork:
                 if not edge in bids:
                     bids[edge] = []
                 bids[edge].append(bid)
+        return bids
 
-        #################################
-        ## accept offers, breaking edges
-        #################################
+    def accept_bids(self, bids, centroids, minBiddingRatio):
+        """
+        accept offers, breaking edges
+        """
         accepted = {}
         nodes = list(self.graph.keys())        
         for node in nodes:            
@@ -331,8 +428,6 @@ class SeqNetwork:
             ##if node has already merged, continue
             if not node in self.graph:
                 continue
-            ##point to all edges
-            allEdges = self.graph[node]
             ##get all offers
             offers = bids[node]
             offers = sorted(offers, key = lambda x : -x["weight"])
@@ -343,24 +438,96 @@ class SeqNetwork:
                     ##if the bidding node has accepted an offer, look at other offers
                     if bid["bidding_node"] in accepted:
                         continue
-                    ##commit node to bidding node
-                    self.graph[node] = set([bid["bidding_node"]])
-                    self.graph[bid["bidding_node"]].add(node)
-                    ##remove node from all other edges
-                    for edge in allEdges:                    
-                        if not edge == bid["bidding_node"]:
-                            self.graph[edge] = self.graph[edge].difference(set([node]))
+                    self.commit_bid(node, bid["bidding_node"])
                     break
-                
-        ##########################################                   
-        ## remove edges between any two centroids
-        ##########################################
+
+    def best_bids(self, max_steps, minBiddingRatio, centroids):
+        """
+        Resolve bids with two walks over the graph, storing weights in arrays of one value per node.
+        accept_bids gives each node to its highest bid (ties to the first bidding node) above minBiddingRatio,
+        skipping bidding nodes that have accepted an offer themselves, i.e. earlier nodes that are not centroids
+        and have a bid above minBiddingRatio. The first walk finds the highest bid for each node, so those
+        bidding nodes are known, the second walk keeps the highest remaining bid for each node.
+
+        Returns
+        -------
+        bidders : array
+        the accepted bidding node for each node, -1 if no bid was accepted
+        """
+        node_sizes = self.node_sizes.tolist()
+        total_nodes = len(self.graph)
+        best_weight = array.array('d', [0.0]) * total_nodes
+        for node in self.graph:
+            node_size = node_sizes[node]
+            for edge, steps in self.walk_graph(node, max_steps).items():
+                weight = (node_size**(1/steps))/node_sizes[edge]
+                if weight > best_weight[edge]:
+                    best_weight[edge] = weight
+        accepting = [not node in centroids and best_weight[node] >= minBiddingRatio for node in self.graph]
+        bid_weight = array.array('d', [0.0]) * total_nodes
+        bidders = array.array('i', [-1]) * total_nodes
+        for node in self.graph:
+            node_size = node_sizes[node]
+            ## offers from this node are passed over by the later nodes
+            skipped = accepting[node]
+            for edge, steps in self.walk_graph(node, max_steps).items():
+                if not accepting[edge] or (skipped and edge > node):
+                    continue
+                weight = (node_size**(1/steps))/node_sizes[edge]
+                if weight >= minBiddingRatio and (bidders[edge] < 0 or weight > bid_weight[edge]):
+                    bid_weight[edge] = weight
+                    bidders[edge] = node
+        return bidders
+
+    def commit_bid(self, node, bidding_node):
+        """
+        commit node to bidding node, removing node from all other edges
+        """
+        ##point to all edges
+        allEdges = self.graph[node]
+        self.graph[node] = set([bidding_node])
+        self.graph[bidding_node] = self.graph[bidding_node].union([node])
+        for edge in allEdges:                    
+            if not edge == bidding_node:
+                self.graph[edge] = self.graph[edge].difference(set([node]))
+
+    def remove_centroid_edges(self, centroids):
+        """
+        remove edges between any two centroids
+        """
         for node in self.graph:
             if node in centroids: 
                 rmCents = self.graph[node].difference(centroids)                
                 rmCents.add(node)
                 self.graph[node] = rmCents                        
-                                 
+
+    def family_labels(self):
+        """
+        Label the connected nodes of the graph (families) with a breadth first search over the graph arrays.
+        Nodes are visited in order, so families are numbered from 1 by their largest node.
+        Edges are symmetric after build_graph and remove_edges, each family is the set of nodes reachable from its largest node.
+
+        Returns
+        -------
+        labels : numpy array
+        the family of each node
+        """
+        labels = [0] * len(self.graph)
+        family_idx = 0
+        for node in self.graph:
+            if labels[node]:
+                continue
+            family_idx += 1
+            labels[node] = family_idx
+            queue = [node]
+            while queue:
+                edge = queue.pop()
+                for new_edge in self.graph.neighbor_list(edge):
+                    if not labels[new_edge]:
+                        labels[new_edge] = family_idx
+                        queue.append(new_edge)
+        return numpy.array(labels, dtype=numpy.int64)
+
     def collapse_graph(self):
         """
         Traverse all edges in decending order, based on node size.
@@ -371,38 +538,27 @@ class SeqNetwork:
         families : dict
         the collapsed graph, a dictionary with the largest node as a key and all connected smaller nodes as values
         """
+        labels = self.family_labels()
+        ## the first node of each family is its largest node
+        order = numpy.argsort(labels, kind="mergesort")
+        bounds = numpy.flatnonzero(numpy.diff(labels[order])) + 1
         families = {}
-        collapsed = {}
-        for node in self.graph:
-            if node in collapsed:
-                continue
-            else:
-                collapsed[node] = 0
-            step = 0            
-            walked = set()
-            #walked[node] = 0
-            edges = self.graph[node]
-            while True:                
-                ##avoid redundancy as we traverse the graph, don't walk back
-                edges = edges.difference(walked)
-                # return the edge found and the distance to each edge
-                new_edges = set()
-                for edge in edges:
-                    if edge == node:
-                        continue
-                    walked.add(edge)
-                    for new_edge in set(self.graph[edge]).difference(edges):
-                        new_edges.add(new_edge)
-                if len(new_edges) == 0:
-                    break
-                else:
-                    edges = new_edges
-            walked.add(node)
-            families[node] = walked
-            for edge in walked:
-                collapsed[edge] = 0
+        for family in numpy.split(order, bounds):
+            if len(family):
+                families[int(family[0])] = set(family.tolist())
         return families
 
+    def read_family_labels(self):
+        """
+        Family labels of all reads, aligned with read_names (the reads of each node are stored together)
+
+        Returns
+        -------
+        labels : numpy array
+        the family of each read in read_names
+        """
+        return numpy.repeat(self.family_labels(), self.node_sizes)
+
     def retreive_read_labels(self, families):
         """
         For a given set of families, return a dictionary of reads and read labels
@@ -416,11 +572,9 @@ class SeqNetwork:
         family_idx = 0
         for node in families:
             family_idx += 1
-            read_group = set()
             for idx in families[node]:
-                read_group = read_group.union(self.index_reads[idx])
-            for read in read_group:
-                read_labels[read] = family_idx
+                for read in self.node_reads(idx):
+                    read_labels[read] = family_idx
         return read_labels
     
 def main():
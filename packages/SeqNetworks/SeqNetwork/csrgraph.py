@@ -0,0 +1,94 @@
+import array
+import numpy
+
+"""
+Integer indexed graph stored in CSR form, the neighbors of node i are neighbors[offsets[i]:offsets[i + 1]].
+Nodes are numbered 0 .. N-1 and the arrays are built once, edges changed later (e.g. while partitioning the graph)
+are held as sets for the changed nodes only, and folded back into the arrays with compact().
+"""
+
+
+class CSRGraph:
+    """
+    Adjacency of an integer indexed graph, with dictionary style access (graph[node] -> set of neighbors)
+
+    Attributes
+    ----------
+    offsets : start of each node's neighbors, numpy int64 array of length N + 1
+    neighbors : sorted neighbors of all nodes, numpy int32 array
+    modified : neighbors of the nodes changed since the arrays were built
+    """
+
+    def __init__(self, offsets, neighbors):
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.modified = {}
+
+    @classmethod
+    def from_neighbor_sets(cls, neighbor_sets, total_nodes):
+        """
+        Build the arrays from the neighbors of each node, given in node order
+
+        Parameters
+        ----------
+        neighbor_sets : iterable
+        a set (or any iterable) of neighbors for each node
+        total_nodes : int
+        number of nodes
+
+        Returns
+        -------
+        graph : CSRGraph
+        """
+        offsets = numpy.zeros(total_nodes + 1, dtype=numpy.int64)
+        neighbors = array.array('i')
+        for node, edges in enumerate(neighbor_sets):
+            neighbors.extend(sorted(edges))
+            offsets[node + 1] = len(neighbors)
+        return cls(offsets, numpy.array(neighbors, dtype=numpy.int32))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        return iter(range(len(self)))
+
+    def __contains__(self, node):
+        return isinstance(node, (int, numpy.integer)) and 0 <= node < len(self)
+
+    def keys(self):
+        return range(len(self))
+
+    def items(self):
+        for node in self:
+            yield node, self[node]
+
+    def neighbor_list(self, node):
+        """
+        Neighbors of a node as a list, without building a set
+        """
+        if node in self.modified:
+            return list(self.modified[node])
+        return self.neighbors[self.offsets[node]:self.offsets[node + 1]].tolist()
+
+    def __getitem__(self, node):
+        """
+        Neighbors of a node, as a new set. Changes to the set are not stored, assign it back to the graph instead.
+        """
+        if node in self.modified:
+            return set(self.modified[node])
+        return set(self.neighbors[self.offsets[node]:self.offsets[node + 1]].tolist())
+
+    def __setitem__(self, node, edges):
+        self.modified[node] = set(edges)
+
+    def compact(self):
+        """
+        Rebuild the arrays with the changed neighbors
+        """
+        if not self.modified:
+            return
+        graph = CSRGraph.from_neighbor_sets((self[node] for node in self), len(self))
+        self.offsets = graph.offsets
+        self.neighbors = graph.neighbors
+        self.modified = {}
@@ -0,0 +1,161 @@
+import Levenshtein
+from SeqNetwork.bktree import BKtree
+
+"""
+Neighbor search backends for SeqNetwork. An index is built once per dimension from the unique sequences,
+find(seq) then returns every indexed sequence within the Levenshtein search distance of seq (seq included).
+All backends return the same sequences, they differ in how candidates are found.
+
+- bktree : the BK-tree search, comparing the query against tree nodes with Levenshtein distance
+- pigeonhole : a seed index for Levenshtein distance. A sequence within distance d of the query has at least one
+  of d + 1 contiguous segments unchanged, found in the query shifted by at most d positions.
+  Candidates sharing a seed are verified with Levenshtein distance.
+- hamming : the pigeonhole index without shifts, for sequences of a single length searched with distance <= 1,
+  where Levenshtein and Hamming distances are the same (e.g. UMIs)
+"""
+
+SEARCH_BACKENDS = ("auto", "bktree", "pigeonhole", "hamming")
+
+
+def segment_bounds(length, parts):
+    """
+    Split a sequence length into contiguous segments of near equal size
+
+    Parameters
+    ----------
+    length : int
+    sequence length
+    parts : int
+    number of segments
+
+    Returns
+    -------
+    bounds : list
+    (start, end) tuple for each segment
+    """
+    bounds = [length * i // parts for i in range(parts + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class BKtreeSearch:
+    """
+    Levenshtein search with a BK-tree
+    """
+
+    def __init__(self, seqs, search_dist):
+        self.search_dist = search_dist
+        ## sequences are unique, so no search is needed while inserting
+        self.tree = BKtree(iter(seqs), Levenshtein.distance, None)
+
+    def find(self, seq):
+        return self.tree.find(seq, self.search_dist)
+
+
+class PigeonholeSearch:
+    """
+    Levenshtein search with a seed index over d + 1 segments of each sequence
+
+    Attributes
+    ----------
+    search_dist : the Levenshtein distance searched
+    segments : segment bounds for each sequence length
+    seeds : indexed sequences for each (length, segment, segment string)
+    """
+
+    def __init__(self, seqs, search_dist):
+        self.search_dist = search_dist
+        self.segments = {}
+        self.seeds = {}
+        for seq in seqs:
+            length = len(seq)
+            if not length in self.segments:
+                self.segments[length] = segment_bounds(length, search_dist + 1)
+            for i, (start, end) in enumerate(self.segments[length]):
+                key = (length, i, seq[start:end])
+                if key in self.seeds:
+                    self.seeds[key].append(seq)
+                else:
+                    self.seeds[key] = [seq]
+
+    def shifts(self, length, query_length):
+        return range(-self.search_dist, self.search_dist + 1)
+
+    def candidates(self, seq):
+        """
+        Collect indexed sequences sharing at least one seed with seq
+        """
+        query_length = len(seq)
+        found = set()
+        for length in range(query_length - self.search_dist, query_length + self.search_dist + 1):
+            if not length in self.segments:
+                continue
+            shifts = self.shifts(length, query_length)
+            for i, (start, end) in enumerate(self.segments[length]):
+                for shift in shifts:
+                    qStart = start + shift
+                    qEnd = end + shift
+                    if qStart < 0 or qEnd > query_length:
+                        continue
+                    hits = self.seeds.get((length, i, seq[qStart:qEnd]))
+                    if hits is not None:
+                        found.update(hits)
+        return found
+
+    def find(self, seq):
+        search_dist = self.search_dist
+        return [x for x in self.candidates(seq) if Levenshtein.distance(seq, x) <= search_dist]
+
+
+class HammingSearch(PigeonholeSearch):
+    """
+    Search for sequences of one length within distance <= 1, segments are only compared in place
+    """
+
+    def __init__(self, seqs, search_dist):
+        if search_dist > 1:
+            raise ValueError("Hamming search matches Levenshtein distance for search distances <= 1 only")
+        PigeonholeSearch.__init__(self, seqs, search_dist)
+        if len(self.segments) > 1:
+            raise ValueError("Hamming search requires sequences of a single length")
+
+    def shifts(self, length, query_length):
+        if length != query_length:
+            return ()
+        return (0,)
+
+    def find(self, seq):
+        search_dist = self.search_dist
+        length = len(seq)
+        return [x for x in self.candidates(seq)
+                if len(x) == length and Levenshtein.hamming(seq, x) <= search_dist]
+
+
+def build_search_index(seqs, search_dist, backend="auto"):
+    """
+    Build a neighbor search index over a set of unique sequences
+
+    Parameters
+    ----------
+    seqs : set
+    unique sequences of one dimension
+    search_dist : int
+    the Levenshtein distance searched
+    backend : str
+    one of SEARCH_BACKENDS, "auto" uses hamming for single length sequences searched with distance <= 1,
+    and pigeonhole otherwise
+
+    Returns
+    -------
+    index : an object with a find(seq) method
+    """
+    if not backend in SEARCH_BACKENDS:
+        raise ValueError("search backend must be one of {}".format(", ".join(SEARCH_BACKENDS)))
+    if backend == "auto":
+        backend = "pigeonhole"
+        if search_dist <= 1 and len(set(len(seq) for seq in seqs)) == 1:
+            backend = "hamming"
+    if backend == "bktree":
+        return BKtreeSearch(seqs, search_dist)
+    if backend == "hamming":
+        return HammingSearch(seqs, search_dist)
+    return PigeonholeSearch(seqs, search_dist)
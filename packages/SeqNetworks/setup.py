@@ -15,6 +15,7 @@ setup(
     long_description_content_type="text/markdown",
     install_requires=[
         'python-levenshtein',
+        'numpy',
         'pandas'
     ]
 )
@@ -1,10 +1,22 @@
 import pandas as pd
 import argparse
+import collections
 import re
 from FastqStreamer.FastqReader import FastqReader
 from BamStreamer.BamPairs import read_two_bams
 from VDJdetector.VDJutils import *
 
+## classification stages, in the order they are checked. Each read exits at one stage, named by its classification
+## and the check that decided it. CDR3 read positions are only computed for reads passing the V gene and strand checks.
+READ_STAGES = ["artifact_no_vgene",         ## no V gene alignment
+               "artifact_vgene_identity",   ## V gene below the minimum identity
+               "artifact_vgene_boundary",   ## V gene alignment does not cover the FR3-CDR3 codon
+               "artifact_strand",           ## V and J genes aligned to different strands
+               "artifact_cdr3_order",       ## J gene CDR3 boundary not found after the V gene boundary
+               "artifact_no_j_motif",       ## J gene not on target, and no J motif found
+               "on_target_jgene",           ## V and J genes on target
+               "on_target_j_motif"]         ## V gene on target, J boundary found by the J motif
+
 class VDJdetector(FastqReader):
     """
     Identify VDJ recombinants from V and J gene alignment files.
@@ -16,22 +28,33 @@ class VDJdetector(FastqReader):
     the minimum percent identity for an alignment to be considered good.
     classifications : dict
     classification counts for read alignments
+    j_motifs : JMotifScanner
+    J motif search for reads without an on target J gene alignment
+    stages : OrderedDict
+    number of reads exiting at each classification stage (READ_STAGES)
     """
 
-    def __init__(self, reference_annot_file, identity):
+    def __init__(self, reference_annot_file, identity, compress=False, io_threads=0):
         """
         Parameters
         ----------
         reference_annot_file : Str
         reference annotation file for VJ genes sequences
+        compress : bool
+        write BGZF compressed fastq files (.fastq.gz)
+        io_threads : int
+        number of threads used for compressing output and reading bam files
         """
 
         self.reference = import_VJ_reference(reference_annot_file)
+        self.j_motifs = JMotifScanner(reference_J_motifs(self.reference))
 
-        FastqReader.__init__(self)
+        FastqReader.__init__(self, io_threads)
         self.min_identity = identity
+        self.fastq_ext = ".fastq.gz" if compress else ".fastq"
         self.classifications = {"on_target": 0,                                
                                 "artifact": 0}
+        self.stages = collections.OrderedDict((stage, 0) for stage in READ_STAGES)
 
     def annotate_alignments(self, alignment):
         """
@@ -87,7 +110,7 @@ class VDJdetector(FastqReader):
                                 cigar=read[whichGene]["cigar"],
                                 percentId=read[whichGene]["percent_identity"],
                                 targetLen=len(read[whichGene]["ref_seq"]),
-                                cdr3_pos=read[whichGene]["cdr3_read_pos"],
+                                cdr3_pos=read[whichGene].get("cdr3_read_pos", ""),
                                 locus_type=read[whichGene]["locus_type"],
                                 IDB_type=read[whichGene]["IDB_type"])
         else:
@@ -151,12 +174,36 @@ class VDJdetector(FastqReader):
         """
         header = "name\tv_gene\tv_start\tv_end\tv_qStart\tv_qEnd\tv_score\tv_cigar\tv_percent_id\tv_target_len\tv_cdr3_pos\tv_locus_type\tv_idb_type\tj_gene\tj_start\tj_end\tj_qStart\tj_qEnd\tj_score\tj_cigar\tj_percent_id\tj_target_len\tj_cdr3_pos\tj_locus_type\tj_idb_type\td_seq\tcdr3\tcdr3_qual\tavg_read_qual\n"
         if not filename in self.file_handles_:
-            fh = open(filename, 'w')
-            self.file_handles_[filename] = fh
+            fh = self.open_output(filename)
             fh.write(header)
-        fh = self.file_handles_[filename]
         return filename
 
+    def covers_cdr3(self, alignment, whichGene):
+        """
+        check the gene alignment covers the CDR3 boundary codon, using reference coordinates only
+
+        Parameters
+        ----------
+        alignment : dict
+        annotated gene alignment
+        whichGene : Str
+        which gene "vgene" or "jgene"
+
+        Returns
+        -------
+        has_cdr3 : bool
+        """
+        refStart = alignment["start"]
+        refEnd = alignment["end"]        
+        cdr3_pos = alignment["cdr3_pos"]
+        ##cdr3 position points to start of codon.
+        ##on target must have the complete codon
+        if cdr3_pos is None:
+            return False
+        if whichGene == "vgene":
+            return refEnd >= (cdr3_pos + 2) and refStart <= (cdr3_pos - 1)
+        return refStart <= (cdr3_pos - 1) and refEnd >= (cdr3_pos + 1)
+
     def classify_alignment(self, read, whichGene):
         """
         get alignment information about a read
@@ -175,32 +222,54 @@ class VDJdetector(FastqReader):
         alignment classification string containing alignment information
         """
         
-        classify = ""
-
-        refStart = read[whichGene]["start"]
-        refEnd = read[whichGene]["end"]        
-        cdr3_pos = read[whichGene]["cdr3_pos"]
-        has_cdr3 = False
-
-        ##cdr3 position points to start of codon.
-        ##on target must have the complete codon
-        if cdr3_pos is not None:
-            if whichGene == "vgene" and refEnd >= (cdr3_pos + 2) and refStart <= (cdr3_pos - 1):
-                has_cdr3 = True
-            if whichGene == "jgene" and refStart <= (cdr3_pos - 1) and refEnd >= (cdr3_pos + 1):
-                has_cdr3 = True
-
-        goodAln = False
-        if read[whichGene]["percent_identity"] >= self.min_identity:
-            goodAln = True        
-        
         # both the primer and target region must align to be considered on-target
         # a minimum overlap of 10bases is considered a hit.
-        if has_cdr3 and goodAln:
-            classify = "on_target"
-        else:
-            classify = "artifact"
-        return classify
+        if self.covers_cdr3(read[whichGene], whichGene) and read[whichGene]["percent_identity"] >= self.min_identity:
+            return "on_target"
+        return "artifact"
+
+    def classify_read(self, aln_pair):
+        """
+        classify a read from its annotated V and J gene alignments, running the cheap checks first.
+        The CIGAR is only walked (parse_cdr3_boundaries) for reads with an on target V gene on the same strand as the J gene,
+        for other reads the CDR3 read positions are left unset.
+
+        Parameters
+        ----------
+        aln_pair : dict
+        read alignment information, returned by BamStreamer and annotated by annotate_alignments
+
+        Returns
+        -------
+        stage : Str
+        the stage the read exits at (READ_STAGES), starting with its classification
+        """
+        valn = aln_pair["vgene"]
+        jaln = aln_pair["jgene"]
+        if valn is None:
+            return "artifact_no_vgene"
+        if valn["percent_identity"] < self.min_identity:
+            return "artifact_vgene_identity"
+        if not self.covers_cdr3(valn, "vgene"):
+            return "artifact_vgene_boundary"
+        ##genes must align to the same strand
+        if jaln is not None and valn["strand"] != jaln["strand"]:
+            return "artifact_strand"
+        parse_cdr3_boundaries(valn, aln_pair)
+        if jaln is not None:
+            parse_cdr3_boundaries(jaln, aln_pair)
+            ##on target reads must have a CDR3                
+            if not valn["cdr3_read_pos"] < jaln["cdr3_read_pos"]:
+                return "artifact_cdr3_order"
+            # if both V and J are on-target, then the fragment is on-target
+            if self.classify_alignment(aln_pair, "jgene") == "on_target":
+                aln_pair["cdr3"], aln_pair["cdr3_qual"] = fetch_cdr3(aln_pair, valn, jaln)
+                return "on_target_jgene"
+        ##search for motif in case of J mis-alignment
+        aln_pair, jalnType = search_J_motif(aln_pair, self.j_motifs)
+        if jalnType == "motif_found":
+            return "on_target_j_motif"
+        return "artifact_no_j_motif"
 
     def parse_alignments(self, vbam, jbam, basename):
         """
@@ -222,88 +291,35 @@ class VDJdetector(FastqReader):
         ######################
         # create file handles
         ######################
-        on_target = self.create_fastq_handle("{}_on_target.fastq".format(basename))
+        on_target = self.create_fastq_handle("{}_on_target{}".format(basename, self.fastq_ext))
         on_target_hits = self.create_stats_handle("{}_on_target.tsv".format(basename))
-        artifacts = self.create_fastq_handle("{}_artifacts.fastq".format(basename))
+        artifacts = self.create_fastq_handle("{}_artifacts{}".format(basename, self.fastq_ext))
         artifacts_hits = self.create_stats_handle("{}_artifacts.tsv".format(basename))
         ##no_aln = self.create_fastq_handle("{}_no_aln.fastq".format(basename))
         #############################
         # filter reads by alignment
         #############################
-        for aln_pair in read_two_bams(vbam, "vgene", jbam, "jgene"):            
+        for aln_pair in read_two_bams(vbam, "vgene", jbam, "jgene",
+                                      threads=max(self.io_threads_, 1)):            
             ##fetch CDR3 annotation
             aln_pair["vgene"] = self.annotate_alignments(aln_pair["vgene"])
             aln_pair["jgene"] = self.annotate_alignments(aln_pair["jgene"])
-            ## prep read info
-            aln_pair["vgene"] = parse_cdr3_boundaries(aln_pair["vgene"], aln_pair)
-            aln_pair["jgene"] = parse_cdr3_boundaries(aln_pair["jgene"], aln_pair)
-            read_name = aln_pair["read_name"]
-            vals = read_name.split(" ")[0].split(":")
             aln_pair["Dregion"] = ""
             aln_pair["cdr3"] = ""
             aln_pair["cdr3_qual"] = ""
             ##if both genes aligned
             if aln_pair["vgene"] is not None and aln_pair["jgene"] is not None:            
-                valnType = self.classify_alignment(aln_pair, "vgene")
-                jalnType = self.classify_alignment(aln_pair, "jgene")
-                ##compare strands
-                vStrand = aln_pair["vgene"]["strand"]
-                jStrand = aln_pair["jgene"]["strand"]
-                ## fetch cdr3 stats
-                cdr3End = aln_pair["jgene"]["cdr3_read_pos"]
-                cdr3Start = aln_pair["vgene"]["cdr3_read_pos"]
                 ## query for read position
                 DStart = aln_pair["vgene"]["query_end"]
                 DEnd = aln_pair["jgene"]["query_start"]                
                 if DStart < DEnd:
                     aln_pair["Dregion"] = aln_pair["seq"][DStart:(DEnd - 1)]
-                else:
-                    aln_pair["Dregion"] = ""
-                ##on target reads must have a CDR3                
-                if not cdr3Start < cdr3End:                    
-                    valnType = "artifact"
-                    jalnType = "artifact"
-                ##genes must align to the same strand
-                if not vStrand == jStrand:
-                    valnType = "artifact"
-                    jalnType = "artifact"                    
-                # if both V and J are on-target, then the fragment is on-target
-                if valnType == "on_target" and jalnType == "on_target":
-                    cdr3 = fetch_cdr3(aln_pair, aln_pair["vgene"], aln_pair["jgene"])
-                    aln_pair["cdr3"] = cdr3[0]
-                    aln_pair["cdr3_qual"] = cdr3[1]
-                    self.classifications["on_target"] += 1
-                    self.write_fastq(aln_pair, on_target)
-                    self.write_aln_stats(aln_pair, on_target_hits)
-                elif valnType == "on_target" and jalnType == "artifact":                                        
-                    ##search for motif in case of J mis-alignment
-                    aln_pair, jalnType = search_J_motif(aln_pair)
-                    if jalnType == "motif_found":
-                        self.classifications["on_target"] += 1
-                        self.write_fastq(aln_pair, on_target)
-                        self.write_aln_stats(aln_pair, on_target_hits)
-                    else:
-                        self.classifications["artifact"] += 1
-                        self.write_fastq(aln_pair, artifacts)
-                        self.write_aln_stats(aln_pair, artifacts_hits)
-                else:
-                    ##otherwise artifacts
-                    self.classifications["artifact"] += 1
-                    self.write_fastq(aln_pair, artifacts)
-                    self.write_aln_stats(aln_pair, artifacts_hits)
-            elif aln_pair["vgene"] is not None and aln_pair["jgene"] is None:
-                valnType = self.classify_alignment(aln_pair, "vgene")
-                jalnType = "missing"
-                if valnType == "on_target":
-                    aln_pair, jalnType = search_J_motif(aln_pair)
-                if jalnType == "motif_found":
-                    self.classifications["on_target"] += 1
-                    self.write_fastq(aln_pair, on_target)
-                    self.write_aln_stats(aln_pair, on_target_hits)
-                else:
-                    self.classifications["artifact"] += 1
-                    self.write_fastq(aln_pair, artifacts)
-                    self.write_aln_stats(aln_pair, artifacts_hits)
+            stage = self.classify_read(aln_pair)
+            self.stages[stage] += 1
+            if stage.startswith("on_target"):
+                self.classifications["on_target"] += 1
+                self.write_fastq(aln_pair, on_target)
+                self.write_aln_stats(aln_pair, on_target_hits)
             else:
                 self.classifications["artifact"] += 1
                 self.write_fastq(aln_pair, artifacts)
@@ -312,7 +328,7 @@ class VDJdetector(FastqReader):
         
     def summarize(self, basename):
         """
-        write summary of alignment categories to file
+        write summary of alignment categories to file, followed by the number of reads exiting at each classification stage
 
         Parameters
         ----------
@@ -327,6 +343,9 @@ class VDJdetector(FastqReader):
         vals = []
         for key in keys:
             vals.append(str(self.classifications[key]))
+        for stage in READ_STAGES:
+            keys.append(stage)
+            vals.append(str(self.stages[stage]))
         reportFile = "{}_alignment_summary.csv".format(basename)
         with open(reportFile, 'w') as Fh:
             Fh.write(",".join(keys)+"\n")
@@ -353,8 +372,18 @@ def main():
                         default=85,
                         type=int,
                         help="minimum gene identity to be considered a good alignment")
+    parser.add_argument("-z", "--compress",
+                        required=False,
+                        action='store_true',
+                        default=False,
+                        help="write BGZF compressed fastq files (.fastq.gz)")
+    parser.add_argument("-t", "--threads",
+                        required=False,
+                        type=int,
+                        default=0,
+                        help="number of threads used for compressing output and reading bam files")
     args = parser.parse_args()
-    parser = VDJdetector(args.reference_info, args.identity)
+    parser = VDJdetector(args.reference_info, args.identity, args.compress, args.threads)
     parser.parse_alignments(args.vgene_aln,
                             args.jgene_aln,
                             args.basename)
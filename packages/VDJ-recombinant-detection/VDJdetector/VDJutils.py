@@ -10,6 +10,14 @@ CDR3 boundaries (immunoDB annotation) for V genes (FR3--CDR3) and Jgenes (CDR3--
 
 """
 
+## cigar string operations and their pysam codes
+CIGAR_REGEX = re.compile(r'(\d+)([MIDNSHP=X])')
+CIGAR_CODES = {'M': 0, 'I': 1, 'D': 2, 'N': 3, 'S': 4, 'H': 5, 'P': 6, '=': 7, 'X': 8}
+## cig2tups codes of the operations walked through an alignment
+CIG2TUPS_CODES = {'M': 0, 'X': -1, 'I': 1, 'D': 2}
+## J gene CDR3 boundary motif, [FW]G[A-Z]G
+J_MOTIF = "(TT[TC]|TGG)GG....GG."
+
 def import_VJ_reference(reference_info_file):
     """
     Read VJ reference file as a dictionary of records
@@ -35,20 +43,55 @@ def import_VJ_reference(reference_info_file):
         genes['IDB_type'] = ""
     if not 'name' in genes:
         genes['name'] = ""
+    if not 'J_motif' in genes:
+        genes['J_motif'] = None
 
-    for seqId, seq, refName, cdr3_pos, locus_type, idb_type in zip(genes['sequence_id'],
-                                                                   genes["sequence"],
-                                                                   genes["name"],
-                                                                   genes['CDR3_target_pos'],
-                                                                   genes['locus_type'],
-                                                                   genes['IDB_type']):
+    for seqId, seq, refName, cdr3_pos, locus_type, idb_type, j_motif in zip(genes['sequence_id'],
+                                                                            genes["sequence"],
+                                                                            genes["name"],
+                                                                            genes['CDR3_target_pos'],
+                                                                            genes['locus_type'],
+                                                                            genes['IDB_type'],
+                                                                            genes['J_motif']):
         if not seqId in reference:                
             reference[seqId] = {"seq": seq,                                    
                                 "cdr3_pos": cdr3_pos,
                                 "locus_type": locus_type,
-                                "IDB_type": idb_type}
+                                "IDB_type": idb_type,
+                                "J_motif": j_motif if isinstance(j_motif, str) and j_motif else None}
     return reference
 
+def gene_locus(refName):
+    """
+    Locus of a V or J gene from its reference name prefix, e.g. TRB for TRBV5-1*01 or IGH for IGHJ4*02
+    """
+    return refName[:3]
+
+def reference_J_motifs(reference):
+    """
+    J motif of each locus, from the optional J_motif column of the reference annotation.
+    The locus of a gene is its reference name prefix (gene_locus).
+
+    Parameters
+    ----------
+    reference : dict
+    reference records returned by import_VJ_reference
+
+    Returns
+    -------
+    motifs : dict
+    J motif regular expression for each locus with an annotated motif
+    """
+    motifs = {}
+    for seqId, record in reference.items():
+        if record.get("J_motif") is None:
+            continue
+        locus = gene_locus(seqId)
+        if motifs.get(locus, record["J_motif"]) != record["J_motif"]:
+            raise ValueError("conflicting J motifs for locus {}: {} and {}".format(locus, motifs[locus], record["J_motif"]))
+        motifs[locus] = record["J_motif"]
+    return motifs
+
 
 def parse_cdr3_boundaries(alignment, read):
     """
@@ -78,7 +121,7 @@ def parse_cdr3_boundaries(alignment, read):
     The Goal of this function is to map the CDR3 codon position from the Gene (13) to the Read (18) using the alignment coordinates and cigar.
     This function works in three steps
        1) collect the start positions of the Gene alignment against the Read
-       2) walk the cigar, updating the position of the Read to the corresponding Gene position.
+       2) walk the cigar one operation at a time, computing the Read position of each Gene position in the operation (map_ref_positions).
        3) If the Read alignment spans the CDR3 codon start and end positions, update the alignment information with the read CDR3 position.  
 
     Finally, Since the CDR3 start and end positions are annotated at the codon level, the CDR3 read position is adjusted to the first base of the CDR3-start codon (V genes) and the last base of the CDR3-end codon (J genes).
@@ -91,26 +134,13 @@ def parse_cdr3_boundaries(alignment, read):
     if alignment['cdr3_pos'] is None:
         alignment['cdr3_read_pos'] = -1
         return alignment
-    cigar_tups = cig2tups(alignment['cigar'])
-    ref_pos = alignment['start'] + 1
-    read_pos = alignment['query_start']
-    read_end = alignment['query_end']
     cdr3_codon_start = alignment['cdr3_pos']
     cdr3_codon_end = alignment['cdr3_pos'] + 3
-    # useful variables
-    cdr3Start = 0
-    cdr3End = 0
-    # walk down the alignment, parse sequence of the cdr3 boundary.
-    for cig_type, cig_len in cigar_tups:
-        for i in range(cig_len):
-            # boundary start
-            if ref_pos == cdr3_codon_start:
-                cdr3Start = read_pos
-            if ref_pos == cdr3_codon_end:
-                cdr3End = read_pos
-            # move down alignment
-            ref_pos, read_pos = walk_cigar(
-                cig_type, ref_pos, read_pos)
+    # map the cdr3 boundary codon down the alignment, block by block
+    readPositions = map_ref_positions(alignment_cigar(alignment), alignment['start'] + 1, alignment['query_start'],
+                                      (cdr3_codon_start, cdr3_codon_end))
+    cdr3Start = readPositions.get(cdr3_codon_start, 0)
+    cdr3End = readPositions.get(cdr3_codon_end, 0)
     if (cdr3End - cdr3Start) == 3 and cdr3End > 0:
         if alignment['reference_name'][3] == 'V':                
             alignment['cdr3_read_pos'] = cdr3Start
@@ -164,21 +194,71 @@ def cig2tups(cigar):
     -------
     cigar_tups : list of tuples
     """
-    cigar_tups = []
-    for x in re.findall('(\d+[MSXID])', cigar):
-        cig_val = int(re.sub("[MSXID]", "", str(x)))
-        cig_type = re.sub(str(cig_val), "", str(x))
-        if cig_type == 'S':
-            continue
-        if cig_type == 'M':
-            cigar_tups.append((0, cig_val))
-        if cig_type == 'X':
-            cigar_tups.append((-1, cig_val))
-        if cig_type == 'I':
-            cigar_tups.append((1, cig_val))
-        if cig_type == 'D':
-            cigar_tups.append((2, cig_val))
-    return cigar_tups
+    return [(CIG2TUPS_CODES[cig_type], int(cig_val)) for cig_val, cig_type in CIGAR_REGEX.findall(cigar)
+            if cig_type in CIG2TUPS_CODES]
+
+def alignment_cigar(alignment):
+    """
+    pysam style cigar tuples (operation code, length) of an alignment, taken from the pysam record when available
+
+    Parameters
+    ----------
+    alignment : dict
+    alignment dictionary returned by BamStreamer
+
+    Returns
+    -------
+    cigartuples : list of tuples
+    """
+    read = alignment.get('pyread')
+    if read is not None:
+        return read.cigartuples
+    return [(CIGAR_CODES[cig_type], int(cig_val)) for cig_val, cig_type in CIGAR_REGEX.findall(alignment['cigar'])]
+
+def map_ref_positions(cigartuples, ref_pos, read_pos, positions):
+    """
+    Map reference positions to read positions, jumping through the alignment one cigar operation at a time.
+    Matches the base by base walk (walk_cigar) over M, X, I and D operations, other operations are not walked:
+    a reference position maps to the last read position visited at it, so an insertion at a position moves it
+    to the end of the insertion (the following match or mismatch position, if any).
+
+    Parameters
+    ----------
+    cigartuples : list of tuples
+    pysam style cigar tuples (operation code, length)
+    ref_pos : int
+    reference position at the start of the alignment
+    read_pos : int
+    read position at the start of the alignment
+    positions : tuple
+    reference positions to map
+
+    Returns
+    -------
+    readPositions : dict
+    read position of each reference position visited by the alignment
+    """
+    readPositions = {}
+    last = max(positions)
+    for cig_type, cig_len in cigartuples:
+        if ref_pos > last:
+            break
+        if cig_type == 0 or cig_type == 8:  # mapped or mismatch
+            for pos in positions:
+                if ref_pos <= pos < ref_pos + cig_len:
+                    readPositions[pos] = read_pos + int(pos - ref_pos)
+            ref_pos += cig_len
+            read_pos += cig_len
+        elif cig_type == 1:  # insertion
+            if cig_len > 0 and ref_pos in positions:
+                readPositions[ref_pos] = read_pos + cig_len - 1
+            read_pos += cig_len
+        elif cig_type == 2:  # deletion
+            for pos in positions:
+                if ref_pos <= pos < ref_pos + cig_len:
+                    readPositions[pos] = read_pos
+            ref_pos += cig_len
+    return readPositions
 
 def walk_cigar(cig_type, query_pos, read_pos):
     """
@@ -212,7 +292,82 @@ def walk_cigar(cig_type, query_pos, read_pos):
         query_pos += 1
     return (query_pos, read_pos)
 
-def search_J_motif(aln_pair):
+class JMotifScanner:
+    """
+    Search reads for the J gene CDR3 boundary motif downstream of the V gene CDR3 position, with patterns
+    compiled once. Loci can have their own motif, other loci use the default motif.
+
+    Attributes
+    ----------
+    default : compiled J motif pattern
+    patterns : compiled J motif pattern for each locus
+    """
+
+    def __init__(self, motifs=None, default=J_MOTIF):
+        """
+        Parameters
+        ----------
+        motifs : dict
+        J motif regular expression for each locus (see reference_J_motifs)
+        default : str
+        J motif regular expression used for other loci
+        """
+        self.default = re.compile(default)
+        self.patterns = {locus: re.compile(motif) for locus, motif in (motifs or {}).items()}
+
+    def find(self, seq, cdr3Start, locus=None):
+        """
+        Find the first motif starting after cdr3Start
+
+        Parameters
+        ----------
+        seq : str
+        read sequence
+        cdr3Start : int
+        read position of the V gene CDR3 boundary
+        locus : str
+        locus of the V gene (gene_locus), selecting the motif
+
+        Returns
+        -------
+        cdr3End : int
+        read position of the J gene CDR3 boundary (the end of the first motif codon), -1 if no motif is found
+        """
+        hit = self.patterns.get(locus, self.default).search(seq, max(cdr3Start + 1, 0))
+        if hit is None:
+            return -1
+        return hit.start() + 3
+
+    def find_all(self, seqs, cdr3Starts, loci=None):
+        """
+        Find the J gene CDR3 boundary of many reads at once, see find()
+
+        Parameters
+        ----------
+        seqs : list
+        read sequences
+        cdr3Starts : list
+        read position of the V gene CDR3 boundary of each read
+        loci : list
+        locus of each read, the default motif is used for all reads if None
+
+        Returns
+        -------
+        cdr3Ends : list
+        read position of the J gene CDR3 boundary of each read, -1 if no motif is found
+        """
+        if loci is None:
+            search = self.default.search
+            cdr3Ends = []
+            for seq, cdr3Start in zip(seqs, cdr3Starts):
+                hit = search(seq, max(cdr3Start + 1, 0))
+                cdr3Ends.append(-1 if hit is None else hit.start() + 3)
+            return cdr3Ends
+        return [self.find(seq, cdr3Start, locus) for seq, cdr3Start, locus in zip(seqs, cdr3Starts, loci)]
+
+DEFAULT_J_SCANNER = JMotifScanner()
+
+def search_J_motif(aln_pair, scanner=DEFAULT_J_SCANNER):
         """
         for read with an identified vgene, but no jgene, look for the J cdr3 boundary motif: [FW]G[A-Z]G
         
@@ -220,6 +375,8 @@ def search_J_motif(aln_pair):
         ----------
         aln_pair : dict
         read alignment information, returned by BamStreamer and CDR3/alignment classified
+        scanner : JMotifScanner
+        J motif search, using the motif of the V gene locus
         
         Returns
         -------
@@ -227,20 +384,9 @@ def search_J_motif(aln_pair):
         tuple of aln_pair object and alignment classification for J
         """
         jalnType = "missing"
-        cdr3Start = aln_pair["vgene"]["cdr3_read_pos"]
-        ##look for [FW]G[A-Z]G motif
-        motif = "(TT[TC]|TGG)GG....GG."
-        found = 0
-        cdr3End = -1
-        jStats = {}
-        for x in re.finditer(motif, aln_pair["seq"]):            
-            if x.start() > cdr3Start:
-                found += 1
-                cdr3End = int(x.start()) + 3
-                jStats["cdr3_read_pos"] = cdr3End
-                break
-        if found > 0:            
-            cdr3 = fetch_cdr3(aln_pair, aln_pair["vgene"], jStats)
+        cdr3End = scanner.find(aln_pair["seq"], aln_pair["vgene"]["cdr3_read_pos"], gene_locus(aln_pair["vgene"]["reference_name"]))
+        if cdr3End != -1:
+            cdr3 = fetch_cdr3(aln_pair, aln_pair["vgene"], {"cdr3_read_pos": cdr3End})
             aln_pair["cdr3"] = cdr3[0]
             aln_pair["cdr3_qual"] = cdr3[1]
             jalnType = "motif_found"
@@ -0,0 +1,68 @@
+import heapq
+from BamStreamer.BamUtils import read_alignments
+from BamStreamer.BamPairs import set_seq_info
+
+
+"""
+Stream any number of name sorted bam files together by read name, e.g. alignments of the same reads
+against V primers, J primers, V genes, J genes and spike-ins, so all of them are read in a single pass.
+
+"""
+
+
+def read_bams(bams, fields=None, threads=1):
+    """
+    Read name sorted bam files, combine and return read alignment information from all files.
+    Files are merged with a heap ordered by the read name keys computed in read_alignments,
+    each record returned holds at most one alignment from every file.
+
+    Parameters
+    ----------
+    bams : dict or list
+    bam file paths keyed by the name to store for each file, or a list of (name, path) pairs
+    fields : list
+    alignment fields to compute for each bam record (see BamUtils.read_alignments), all fields if None
+    threads : int
+    number of threads used for BGZF decompression of each bam file
+
+    Yields
+    ------
+    alnRecord : dict
+    alignment (or None) for each bam name, with read info added by set_seq_info
+    """
+    if isinstance(bams, dict):
+        bams = list(bams.items())
+    names = [name for name, _ in bams]
+    if len(set(names)) != len(names):
+        raise ValueError("bam names must be unique")
+    if fields is not None and not 'pyread' in fields:
+        ## set_seq_info reads the sequence from the pysam record
+        fields = list(fields) + ['pyread']
+    readers = [read_alignments(path, fields, threads) for _, path in bams]
+    ##heap entries: (name key, read name, file index, alignment)
+    heap = []
+    for i, reader in enumerate(readers):
+        aln = next(reader, None)
+        if aln is not None:
+            heap.append((aln["name_key"], aln["query_name"], i, aln))
+    heapq.heapify(heap)
+    while heap:
+        alnRecord = dict.fromkeys(names)
+        query_name = heap[0][1]
+        ##collect the current alignment of every file holding this read,
+        ##a following record of the same read in one file is returned with the next record
+        deferred = []
+        while heap and heap[0][1] == query_name:
+            entry = heapq.heappop(heap)
+            i = entry[2]
+            if alnRecord[names[i]] is not None:
+                deferred.append(entry)
+                continue
+            alnRecord[names[i]] = entry[3]
+            nextAln = next(readers[i], None)
+            if nextAln is not None:
+                heapq.heappush(heap, (nextAln["name_key"], nextAln["query_name"], i, nextAln))
+        for entry in deferred:
+            heapq.heappush(heap, entry)
+        first = next(alnRecord[name] for name in names if alnRecord[name] is not None)
+        yield set_seq_info(alnRecord, first)
@@ -1,6 +1,5 @@
 import pysam
 from BamStreamer.BamUtils import read_alignments
-from BamStreamer.BamUtils import cmp
 
 
 """
@@ -8,8 +7,11 @@ Stream Two bam file alignments by read name. Useful for reading alignments for r
 
 """
 
+## read fields set on each pair by set_seq_info
+SEQ_INFO_FIELDS = ('seq', 'quality_values', 'qual', 'avgQual')
 
-def set_seq_info(alnPair, alignment):
+
+def set_seq_info(alnPair, alignment, read_fields=SEQ_INFO_FIELDS):
     """
     Parse read stats from bam record, record high level stats as new dict values
 
@@ -19,6 +21,8 @@ def set_seq_info(alnPair, alignment):
     dictionary of bam Pair info from read_two_bams()
     alignment : dict
     bam file record, returned by BamParser
+    read_fields : tuple
+    read fields to set (see SEQ_INFO_FIELDS), 'read_name' is always set
 
     Returns
     -------
@@ -26,13 +30,20 @@ def set_seq_info(alnPair, alignment):
     dictionary with new fields, summarizing read information from bam format
     """
     alnPair["read_name"] = alignment["query_name"]
-    alnPair["seq"] = alignment["pyread"].query_sequence
-    alnPair["quality_values"] = alignment["pyread"].query_qualities
-    alnPair["qual"] = alignment["pyread"].qual
-    alnPair["avgQual"] = sum(alnPair["quality_values"])/len(alnPair["quality_values"])
+    read = alignment["pyread"]
+    if 'seq' in read_fields:
+        alnPair["seq"] = read.query_sequence
+    if 'quality_values' in read_fields:
+        alnPair["quality_values"] = read.query_qualities
+    if 'qual' in read_fields:
+        alnPair["qual"] = read.qual
+    ##the mean quality is the costly field, only computed when requested
+    if 'avgQual' in read_fields:
+        quals = read.query_qualities
+        alnPair["avgQual"] = sum(quals)/len(quals)
     return alnPair
 
-def read_two_bams(bam1, bam1Name, bam2, bam2Name):
+def read_two_bams(bam1, bam1Name, bam2, bam2Name, fields=None, threads=1, read_fields=SEQ_INFO_FIELDS):
     """
     Read two bam files, combine and return read alignment information from both files.
     Keeping track of read names and read names order, ensure pairs are returned in proper order.
@@ -47,9 +58,18 @@ def read_two_bams(bam1, bam1Name, bam2, bam2Name):
     path to second bam file
     bam2Name : str
     The name to store for the second bam File
+    fields : list
+    alignment fields to compute for each bam record (see BamUtils.read_alignments), all fields if None
+    threads : int
+    number of threads used for BGZF decompression of each bam file
+    read_fields : tuple
+    read fields set on each pair (see SEQ_INFO_FIELDS), all of them by default
     """
-    reader1 = read_alignments(bam1)
-    reader2 = read_alignments(bam2)        
+    if fields is not None and not 'pyread' in fields:
+        ## set_seq_info reads the sequence from the pysam record
+        fields = list(fields) + ['pyread']
+    reader1 = read_alignments(bam1, fields, threads)
+    reader2 = read_alignments(bam2, fields, threads)        
     r1 = next(reader1, None)
     r2 = next(reader2, None)
     while True:
@@ -60,30 +80,31 @@ def read_two_bams(bam1, bam1Name, bam2, bam2Name):
         elif r1 is None:
             ##keep reading r2 if r1 is done
             alnPair[bam2Name]=r2
-            alnPair = set_seq_info(alnPair, r2)
+            alnPair = set_seq_info(alnPair, r2, read_fields)
             r2 = next(reader2, None)
         elif r2 is None:
             ##keep reading r1 if r2 is done
             alnPair[bam1Name]=r1
-            alnPair = set_seq_info(alnPair, r1)
+            alnPair = set_seq_info(alnPair, r1, read_fields)
             r1 = next(reader1, None)
         else:
             ##both alignments exist and are the same
             if r1["query_name"] == r2["query_name"]:
                 alnPair[bam1Name]=r1
                 alnPair[bam2Name]=r2
-                alnPair = set_seq_info(alnPair, r1)
+                alnPair = set_seq_info(alnPair, r1, read_fields)
                 r1 = next(reader1, None)
                 r2 = next(reader2, None)
             ##r1 alignments are behind r2, keep reading r1
-            elif cmp(r1["query_name"], r2["query_name"]) < 0:
+            ## (name keys are precomputed by read_alignments)
+            elif r1["name_key"] < r2["name_key"]:
                 alnPair[bam1Name]=r1
-                alnPair = set_seq_info(alnPair, r1)
+                alnPair = set_seq_info(alnPair, r1, read_fields)
                 r1 = next(reader1, None)
             ##r2 alignments are behind r1, keep reading r2
-            elif cmp(r1["query_name"], r2["query_name"]) > 0:
+            else:
                 alnPair[bam2Name]=r2
-                alnPair = set_seq_info(alnPair, r2)
+                alnPair = set_seq_info(alnPair, r2, read_fields)
                 r2 = next(reader2, None)
         yield alnPair
                     
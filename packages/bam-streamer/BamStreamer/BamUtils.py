@@ -1,6 +1,27 @@
 import pysam
 
-def read_alignments(fname):
+## alignment fields computed from the cigar stats of a read
+CIGAR_STAT_FIELDS = {'percent_identity', 'mismatches', 'insertions', 'deletions', 'clipped'}
+
+## field name -> function(read, cigar_stats), for alignments read with a field list
+ALIGNMENT_FIELDS = {
+    'reference_name': lambda read, cigar_stats: read.reference_name,
+    'start': lambda read, cigar_stats: read.reference_start + 1,
+    'end': lambda read, cigar_stats: read.reference_end,
+    'query_start': lambda read, cigar_stats: read.query_alignment_start + 1,
+    'query_end': lambda read, cigar_stats: read.query_alignment_end,
+    'score': lambda read, cigar_stats: read.get_tag('AS'),
+    'cigar': lambda read, cigar_stats: read.cigarstring,
+    'percent_identity': lambda read, cigar_stats: cigar_stats[0] * 100 / sum([cigar_stats[0], cigar_stats[1], cigar_stats[2], cigar_stats[8]]),
+    'mismatches': lambda read, cigar_stats: cigar_stats[8],
+    'insertions': lambda read, cigar_stats: cigar_stats[1],
+    'deletions': lambda read, cigar_stats: cigar_stats[2],
+    'clipped': lambda read, cigar_stats: cigar_stats[4],
+    'strand': lambda read, cigar_stats: "-" if read.is_reverse else "+",
+    'pyread': lambda read, cigar_stats: read
+}
+
+def read_alignments(fname, fields=None, threads=1):
     """
     Read Primary alignments from Bam File, calculating high level stats from pysam alignment object.
 
@@ -8,24 +29,49 @@ def read_alignments(fname):
     ----------
     fname : path
         Path to swifr aligned BAM/SAM file.
+    fields : list
+        alignment fields to compute (keys of ALIGNMENT_FIELDS), all fields if None.
+        'query_name' and 'name_key' are always returned.
+    threads : int
+        number of threads used for BGZF decompression.
 
     Yields
     ------
     alignment : dict
         Dictionary containing the alignment information of the read.
     """
-    with pysam.AlignmentFile(fname, check_sq=False) as sam:
+    if fields is not None:
+        unknown = set(fields) - set(ALIGNMENT_FIELDS) - {'query_name', 'name_key'}
+        if unknown:
+            raise ValueError("unknown alignment fields: {}".format(", ".join(sorted(unknown))))
+        fields = [field for field in fields if field in ALIGNMENT_FIELDS]
+        getters = [(field, ALIGNMENT_FIELDS[field]) for field in fields]
+        need_stats = any(field in CIGAR_STAT_FIELDS for field in fields)
+    with pysam.AlignmentFile(fname, check_sq=False, threads=threads) as sam:
         prev_query_name = None
+        prev_key = None
         for read in sam.fetch(until_eof=True):
             if not read.is_unmapped and not read.is_secondary and not read.is_supplementary:
-                assert prev_query_name is None or cmp(prev_query_name, read.query_name) <= 0, 'File is not sorted by query name.'
-                prev_query_name = read.query_name
+                ## one sort key per read name, records of the same read share it
+                if read.query_name != prev_query_name:
+                    key = name_key(read.query_name)
+                    assert prev_key is None or prev_key <= key, 'File is not sorted by query name.'
+                    prev_query_name = read.query_name
+                    prev_key = key
+                if fields is not None:
+                    cigar_stats = read.get_cigar_stats()[0] if need_stats else None
+                    alignment = {'query_name': read.query_name, 'name_key': key}
+                    for field, getter in getters:
+                        alignment[field] = getter(read, cigar_stats)
+                    yield alignment
+                    continue
                 strand = "+"
                 if read.is_reverse:
                     strand = "-"                    
                 cigar_stats = read.get_cigar_stats()[0]
                 alignment = {
                     'query_name': read.query_name,
+                    'name_key': key,
                     'reference_name': read.reference_name,
                     'start': read.reference_start + 1,
                     'end': read.reference_end,
@@ -44,6 +90,27 @@ def read_alignments(fname):
 
                 yield alignment
 
+def name_key(query_name):
+    """Sort key for a read name.
+
+    Fields in read names (separated by ':') are compared as string or integer depends on their types,
+    so keys compare in the same order as `cmp`. Keys are computed once per read name and compared
+    directly, e.g. Illumina names 'NB551443:36:HJ2FHAFXY:1:11101:5290:1029' become
+    ('NB551443', 36, 'HJ2FHAFXY', 1, 11101, 5290, 1029).
+
+    Parameters
+    ----------
+    query_name : str
+        read name
+
+    Returns
+    -------
+
+    tuple
+        read name fields, digit fields converted to int
+    """
+    return tuple([int(field) if field.isdigit() else field for field in query_name.split(':')])
+
 def cmp(q1, q2):
     """Compare read names.
 
@@ -64,16 +131,10 @@ def cmp(q1, q2):
     """
     if q1 == q2:
         return 0
-    q1 = q1.split(':')
-    q2 = q2.split(':')
-    for a, b in zip(q1, q2):
-        if a.isdigit():
-            a = int(a)
-        if b.isdigit():
-            b = int(b)
-        if a < b:
-            return -1
-        elif a > b:
-            return 1
-        else:
-            continue
+    k1 = name_key(q1)
+    k2 = name_key(q2)
+    if k1 < k2:
+        return -1
+    elif k1 > k2:
+        return 1
+    return 0
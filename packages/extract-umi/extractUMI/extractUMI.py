@@ -1,7 +1,16 @@
 import argparse
+import numpy
 import pandas
 import re
 
+## quality characters of compact UMI labels (parse-umi --compact): '!'-'~' without ':', '@', '_'
+COMPACT_QUALS = "".join(chr(c) for c in range(33, 127) if not chr(c) in ":@_")
+COMPACT_DECODE = str.maketrans(COMPACT_QUALS, "".join(chr(q + 33) for q in range(len(COMPACT_QUALS))))
+COMPACT_SUFFIX = "_c"
+## comma separated quality integer -> Phred+33 character
+QUAL_CHARS = {str(q): chr(q + 33) for q in range(-33, 223)}
+CHUNK_SIZE = 500000
+
 def umi_delim_extract(readName, regex):
     """
     Given a read name with UMI_R1 or UMI_R2 header labels from parse-umi, 
@@ -39,15 +48,98 @@ def convert_quals(qualString):
     -------    
     ASCII encoded quality value string
     """
-    qualVals = []
-    for qv in qualString.split(','):
-        qualVals.append(chr(int(qv) + 33))
-    return ''.join(qualVals)
+    try:
+        return ''.join([QUAL_CHARS[qv] for qv in qualString.split(',')])
+    except KeyError:
+        return ''.join([chr(int(qv) + 33) for qv in qualString.split(',')])
+
+def convert_qual_column(qualStrings):
+    """
+    Convert the comma separated quality integers of many UMIs at once, see convert_quals.
+    The digits of all UMIs are parsed together as one numpy byte array and mapped to Phred+33 characters.
+
+    Parameters
+    ----------
+    qualStrings : list
+    read quality values integers of each UMI, separated with a comma
+    
+    Returns
+    -------    
+    list of ASCII encoded quality value strings
+    """
+    if len(qualStrings) == 0:
+        return []
+    ## UMIs are joined with ';', values with ','
+    raw = numpy.frombuffer((";".join(qualStrings) + ";").encode(), dtype=numpy.uint8)
+    umiEnd = raw == ord(";")
+    sep = umiEnd | (raw == ord(","))
+    ##end of each value, and its number of digits
+    valueEnds = numpy.flatnonzero(sep)
+    valueLengths = numpy.diff(numpy.concatenate(([-1], valueEnds))) - 1
+    ##signed, empty, long or non numeric values are converted one at a time
+    if ((raw - ord("0") > 9) & ~sep).any() or valueLengths.min() == 0 or valueLengths.max() > 3:
+        return [convert_quals(qualString) for qualString in qualStrings]
+    digits = raw.astype(numpy.int32) - ord("0")
+    values = digits[valueEnds - 1] + 33
+    values += numpy.where(valueLengths > 1, digits[valueEnds - 2] * 10, 0)
+    values += numpy.where(valueLengths > 2, digits[valueEnds - 3] * 100, 0)
+    if values.max() > 255:
+        return [convert_quals(qualString) for qualString in qualStrings]
+    ##quality characters of all UMIs, each followed by a newline (never a quality character)
+    umis = numpy.concatenate(([0], numpy.cumsum(umiEnd[valueEnds[:-1]])))
+    chars = numpy.full(len(valueEnds) + len(qualStrings), ord("\n"), dtype=numpy.uint8)
+    chars[numpy.arange(len(valueEnds)) + umis] = values
+    return chars.tobytes().decode('latin-1').split("\n")[:-1]
 
-def add_umi_columns(report_file, out_file):
+def is_compact_label(readName, pos):
+    """
+    Check whether the UMI label at a position of the read header uses the compact encoding
+
+    Parameters
+    ----------
+    readName : string
+    The read header with umi labels, separated with ':'
+    pos : int
+    position of the UMI label, from umi_delim_extract
+    
+    Returns
+    -------    
+    True if the label name ends with COMPACT_SUFFIX (e.g. UMI_R1_c__SEQ__QUAL)
+    """
+    return readName.split(":")[pos].split("__")[0].endswith(COMPACT_SUFFIX)
+
+def umi_fields(names, pos, compact):
+    """
+    Cut one UMI label from each read header and split it into name, sequence and quality
+
+    Parameters
+    ----------
+    names : pandas.Series
+    read headers with umi labels, separated with ':'
+    pos : int
+    position of the UMI label, from umi_delim_extract
+    compact : bool
+    the label stores compact quality characters
+    
+    Returns
+    -------    
+    (labels, label names, UMI sequences, Phred+33 quality strings) : tuple of lists
+    """
+    ## split only up to the UMI label, the rest of the header is never touched
+    labels = [name.split(":", pos + 1)[pos] for name in names]
+    umi_names, umis, quals = zip(*[label.split("__") for label in labels])
+    if compact:
+        quals = [qual.translate(COMPACT_DECODE) for qual in quals]
+    else:
+        quals = convert_qual_column(quals)
+    return labels, list(umi_names), list(umis), quals
+
+def add_umi_columns(report_file, out_file, chunk_size=CHUNK_SIZE):
     """
     Given a read report table, with read names labeled by `parse-umi`, 
     extract the UMI information and store the UMI string and quality values as columns.
+    Both the comma separated and the compact (--compact) quality labels are read.
+    The report is streamed in chunks, each chunk is appended to the output file.
 
     Parameters
     ----------
@@ -55,29 +147,38 @@ def add_umi_columns(report_file, out_file):
     TSV report of reads with UMI labels
     out_file : path
     the name of the output tsv file
+    chunk_size : int
+    number of report rows held in memory at once
     
     Returns
     -------    
     None
-    """    
-    df = pandas.read_csv(report_file, sep="\t") 
-    if not 'name' in df.columns:
-        raise ValueError("read header column must be stored as 'name'")    
-    ##extract UMI information
-    checkName = df["name"][0]
-    umi1Pos = umi_delim_extract(checkName, "UMI_R1")
-    umi2Pos = umi_delim_extract(checkName, "UMI_R2")
-    ##parse UMI data
-    if umi1Pos is not None:
-        df["umi1"] = df["name"].str.split(":", expand=True)[umi1Pos]
-        df[['umi_r1_name', 'umi_r1', 'umi_r1_qual']] = df["umi1"].str.split("__", expand=True)
-        df["umi_r1_qual"] = df["umi_r1_qual"].apply(convert_quals)
-    if umi2Pos is not None:
-        df["umi2"] = df["name"].str.split(":", expand=True)[umi2Pos]
-        df[['umi_r2_name', 'umi_r2', 'umi_r2_qual']] = df["umi2"].str.split("__", expand=True)
-        df["umi_r2_qual"] = df["umi_r2_qual"].apply(convert_quals)
-    ##write output           
-    df.to_csv(out_file, sep="\t", index=False)
+    """
+    ## columns are kept as text, so column types do not change between chunks.
+    ## missing values (NA, nan, empty) are written back empty, as before
+    reader = pandas.read_csv(report_file, sep="\t", chunksize=chunk_size, dtype=str)
+    umis = None
+    with open(out_file, 'w') as out:
+        for i, df in enumerate(reader):
+            if not 'name' in df.columns:
+                raise ValueError("read header column must be stored as 'name'")
+            ##locate UMI labels from the first read
+            if umis is None and len(df) > 0:
+                checkName = df["name"].iloc[0]
+                umis = []
+                for umi_id, label_col, read in (("UMI_R1", "umi1", "r1"), ("UMI_R2", "umi2", "r2")):
+                    pos = umi_delim_extract(checkName, umi_id)
+                    if pos is not None:
+                        umis.append((pos, label_col, read, is_compact_label(checkName, pos)))
+            ##parse UMI data
+            for pos, label_col, read, compact in (umis or []):
+                labels, umi_names, umi_seqs, quals = umi_fields(df["name"], pos, compact)
+                df[label_col] = labels
+                df["umi_{}_name".format(read)] = umi_names
+                df["umi_{}".format(read)] = umi_seqs
+                df["umi_{}_qual".format(read)] = quals
+            ##write output
+            df.to_csv(out, sep="\t", index=False, header=(i == 0))
 
 
 
@@ -87,9 +188,14 @@ def main():
     parser.add_argument("-r", "--reportFile",
                         required=True,
                         help="tsv read report with UMI labeled read headers")
+    parser.add_argument("-c", "--chunk_size",
+                        type=int,
+                        required=False,
+                        default=CHUNK_SIZE,
+                        help="number of report rows processed at once")
     args = parser.parse_args()
     outFile = args.reportFile.replace(".tsv", "_umi.tsv")
-    add_umi_columns(args.reportFile, outFile)
+    add_umi_columns(args.reportFile, outFile, args.chunk_size)
 
 if __name__ == '__main__':
     main()
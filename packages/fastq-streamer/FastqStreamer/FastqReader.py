@@ -1,3 +1,126 @@
+import gzip
+import io
+import itertools
+import queue
+import threading
+from FastqStreamer.FastqRecord import FastqRecord, FastqPair
+from FastqStreamer.FastqWriter import FastqWriter
+
+GZIP_MAGIC = b"\x1f\x8b"
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def is_gzipped(filename):
+    """
+    Check the first bytes of a file for the gzip magic number (gzip and BGZF)
+
+    Parameters
+    ----------
+    filename : str
+    Path to file
+
+    Returns
+    -------
+    bool : True if the file is gzip/BGZF compressed
+    """
+    with open(filename, 'rb') as fh:
+        return fh.read(2) == GZIP_MAGIC
+
+
+class ThreadedBlockReader(io.RawIOBase):
+    """
+    Decompress a gzip/BGZF file in large blocks from a background thread,
+    so decompression overlaps with record parsing in the main thread.
+
+    Attributes
+    ----------
+    block_size : size of the decompressed blocks passed to the reader
+    """
+
+    def __init__(self, filename, block_size=BLOCK_SIZE, max_blocks=4):
+        self.block_size = block_size
+        self._fh = gzip.open(filename, 'rb')
+        self._blocks = queue.Queue(max_blocks)
+        self._stop = threading.Event()
+        self._buffer = memoryview(b"")
+        self._eof = False
+        self._error = None
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fill(self):
+        try:
+            while True:
+                block = self._fh.read(self.block_size)
+                if not self._put(block) or not block:
+                    break
+        except Exception as e:
+            self._put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self._buffer:
+            ##the worker stops after an error, re-raise it rather than wait for another block
+            if self._error is not None:
+                raise self._error
+            if self._eof:
+                return 0
+            block = self._blocks.get()
+            if isinstance(block, Exception):
+                self._error = block
+                raise block
+            if not block:
+                self._eof = True
+                return 0
+            self._buffer = memoryview(block)
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+            self._fh.close()
+        super().close()
+
+
+def open_fastq(filename, io_threads=0):
+    """
+    Open a fastq file for reading, plain text or gzip/BGZF compressed
+
+    Parameters
+    ----------
+    filename : str
+    Path to fastq file (.fastq or .fastq.gz)
+    io_threads : int
+    if > 0, decompress in a background thread
+
+    Returns
+    -------
+    fh : text file handle
+    """
+    if is_gzipped(filename):
+        if io_threads > 0:
+            raw = io.BufferedReader(ThreadedBlockReader(filename), BLOCK_SIZE)
+        else:
+            raw = io.BufferedReader(gzip.open(filename, 'rb'), BLOCK_SIZE)
+        return io.TextIOWrapper(raw, encoding="latin-1")
+    return open(filename, buffering=BLOCK_SIZE, encoding="latin-1")
+
+
 class FastqReader:
     """
     Utility class for handling fastq formated files
@@ -6,11 +129,13 @@ class FastqReader:
     ----------
     file_handles_ : A dictionary for file handles, used for writing one or more
     Fastq file.
+    io_threads_ : Number of background threads used for (de)compression.
 
     """
 
-    def __init__(self):
+    def __init__(self, io_threads=0):
         self.file_handles_ = {}
+        self.io_threads_ = io_threads
 
     def iter_pairs(self, fastq1, fastq2):
         """
@@ -19,48 +144,105 @@ class FastqReader:
         Parameters
         ----------
         fastq1 : str
-        Path to Fastq file for read1
+        Path to Fastq file for read1 (plain or gzip/BGZF compressed)
         fastq2 : str
-        Path to Fastq file for read2
+        Path to Fastq file for read2 (plain or gzip/BGZF compressed)
 
         Returns
         -------
-        record : dictionary  conatining read pair info (name, seq, qual)
-        """
-        with open(fastq1) as fq1, open(fastq2) as fq2:
-            count = 0
-            record = {"read1": {}, "read2": {}}
-            for read1, read2, in zip(fq1, fq2):
-                if count % 4 == 0:
-                    record = {"read1": {}, "read2": {}}
-                record = self.read_pair_record(read1, read2, count, record)
-                if count % 4 == 3:
-                    yield record
-                count += 1
+        record : FastqPair containing read1 and read2 FastqRecords (name, seq, qual)
+        """
+        with open_fastq(fastq1, self.io_threads_) as fq1, \
+             open_fastq(fastq2, self.io_threads_) as fq2:
+            for (name1, seq1, _, qual1), \
+                (name2, seq2, _, qual2) in zip(zip(fq1, fq1, fq1, fq1),
+                                               zip(fq2, fq2, fq2, fq2)):
+                yield FastqPair(self.read_record(name1, seq1, qual1),
+                                self.read_record(name2, seq2, qual2))
 
     def iter_reads(self, fastq):
         """
         An iterator, returning read info from fastq
 
+        Parameters
+        ----------
+        fastq : str
+        Path to Fastq file (plain or gzip/BGZF compressed)
+
+        Returns
+        -------
+        record : FastqRecord containing read info
+        """
+        with open_fastq(fastq, self.io_threads_) as fq:
+            for name, seq, _, qual in zip(fq, fq, fq, fq):
+                yield self.read_record(name, seq, qual)
+
+    def iter_pair_batches(self, fastq1, fastq2, batch_size=100000):
+        """
+        An iterator, returning lists of read pairs from two fastq files
+
+        Parameters
+        ----------
+        fastq1 : str
+        Path to Fastq file for read1
+        fastq2 : str
+        Path to Fastq file for read2
+        batch_size : int
+        maximum number of read pairs per batch
+
+        Returns
+        -------
+        batch : list of FastqPair records
+        """
+        pairs = self.iter_pairs(fastq1, fastq2)
+        while True:
+            batch = list(itertools.islice(pairs, batch_size))
+            if not batch:
+                break
+            yield batch
+
+    def iter_read_batches(self, fastq, batch_size=100000):
+        """
+        An iterator, returning lists of reads from a fastq file
+
         Parameters
         ----------
         fastq : str
         Path to Fastq file
+        batch_size : int
+        maximum number of reads per batch
 
         Returns
         -------
-        record : dictionary  containing read info
-        """
-        with open(fastq) as fq:
-            count = 0
-            record = {"read1": {}, "read2": {}}
-            for read in fq:
-                if count % 4 == 0:
-                    record = {"read1": {}, "read2": {}}
-                record = self.read_struct(read, count, record, "read1")
-                if count % 4 == 3:
-                    yield record["read1"]
-                count += 1
+        batch : list of FastqRecords
+        """
+        reads = self.iter_reads(fastq)
+        while True:
+            batch = list(itertools.islice(reads, batch_size))
+            if not batch:
+                break
+            yield batch
+
+    def read_record(self, name, seq, qual):
+        """
+        Store the four lines of a fastq record in one step
+
+        Parameters
+        ----------
+        name : str
+        header line from fastq file
+        seq : str
+        sequence line from fastq file
+        qual : str
+        quality line from fastq file
+
+        Returns
+        -------
+        record : FastqRecord containing read info
+        """
+        return FastqRecord(name.rstrip("\n").replace("@", "").split(" ")[0],
+                           seq.rstrip("\n"),
+                           qual.rstrip("\n"))
 
     def read_pair_record(self, read1, read2, count, record):
         """
@@ -111,14 +293,35 @@ class FastqReader:
             record[which_read]["qual"] = line
         return record
 
-    def create_fastq_handle(self, filename):
+    def open_output(self, filename, compression=None):
+        """
+        Open a buffered output file, kept with the other file handles
+
+        Parameters
+        ----------
+        filename : str
+        name of file to be written, names ending with '.gz' are BGZF compressed
+        compression : str
+        "none", "gzip" or "bgzf", inferred from the file name if None
+
+        Returns
+        -------
+        fh : FastqWriter
+        """
+        fh = FastqWriter(filename, compression=compression, threads=self.io_threads_)
+        self.file_handles_[filename] = fh
+        return fh
+
+    def create_fastq_handle(self, filename, compression=None):
         """
         Maintain one or more fastq file handles
 
         Parameters
         ----------
         filename : str
-        name of fastq file to be written
+        name of fastq file to be written, names ending with '.gz' are BGZF compressed
+        compression : str
+        "none", "gzip" or "bgzf", inferred from the file name if None
 
         Returns
         -------
@@ -126,7 +329,7 @@ class FastqReader:
 
         """
         if not filename in self.file_handles_:
-            self.file_handles_[filename] = open(filename, 'w')
+            self.open_output(filename, compression)
         return filename
 
     def write_fastq(self, read, filename):
@@ -135,26 +338,25 @@ class FastqReader:
 
         Parameters
         ----------
-        read : dict
-        dictionary record, containing read information
+        read : FastqRecord or dict
+        record containing read information (read_name, seq, qual)
         filename : str
-        name of fastq file to be written        
+        name of fastq file to be written
 
         Returns
         -------
         None
         """
         fh = self.file_handles_[filename]
-        fastq_lines = "{name}\n{seq}\n{third}\n{qual}\n"
-        trimmed_read = fastq_lines.format(name="@"+read["read_name"],
-                                          seq=read["seq"],
-                                          third="+",
-                                          qual=read["qual"])
-        fh.write(trimmed_read)
+        if isinstance(read, FastqRecord):
+            name, seq, qual = read.read_name, read.seq, read.qual
+        else:
+            name, seq, qual = read["read_name"], read["seq"], read["qual"]
+        fh.write("@{}\n{}\n+\n{}\n".format(name, seq, qual))
 
     def close_file_handles(self):
         """
-        close all fastq files written
+        close all fastq files written, flushing buffered records
 
         Returns
         -------
@@ -0,0 +1,89 @@
+"""
+Compact record types returned by FastqReader. Fields are stored as latin-1
+decoded strings, so every character maps to exactly one byte of the fastq file.
+"""
+
+
+class FastqRecord:
+    """
+    A single fastq record
+
+    Attributes
+    ----------
+    read_name : read header, without '@' and comments
+    seq : read sequence
+    qual : read quality string (Phred+33)
+    """
+    __slots__ = ("read_name", "seq", "qual")
+
+    def __init__(self, read_name, seq, qual):
+        self.read_name = read_name
+        self.seq = seq
+        self.qual = qual
+
+    def __getitem__(self, key):
+        """
+        dictionary style access, kept for code written against the dict records.
+        Unknown keys raise KeyError, as they did for the dicts
+        """
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def __eq__(self, other):
+        if not isinstance(other, FastqRecord):
+            return NotImplemented
+        return (self.read_name, self.seq, self.qual) == (other.read_name, other.seq, other.qual)
+
+    def __repr__(self):
+        return "FastqRecord(read_name={!r}, seq={!r}, qual={!r})".format(self.read_name,
+                                                                        self.seq,
+                                                                        self.qual)
+
+
+class FastqPair:
+    """
+    A read pair, unpacks as (read1, read2)
+
+    Attributes
+    ----------
+    read1 : FastqRecord for read1
+    read2 : FastqRecord for read2
+    """
+    __slots__ = ("read1", "read2")
+
+    def __init__(self, read1, read2):
+        self.read1 = read1
+        self.read2 = read2
+
+    def __getitem__(self, key):
+        """
+        dictionary style access ("read1"/"read2"), kept for code written against the dict records.
+        Unknown keys raise KeyError, as they did for the dicts
+        """
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def __iter__(self):
+        yield self.read1
+        yield self.read2
+
+    def __eq__(self, other):
+        if not isinstance(other, FastqPair):
+            return NotImplemented
+        return self.read1 == other.read1 and self.read2 == other.read2
+
+    def __repr__(self):
+        return "FastqPair(read1={!r}, read2={!r})".format(self.read1, self.read2)
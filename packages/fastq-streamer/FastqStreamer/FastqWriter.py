@@ -0,0 +1,200 @@
+import collections
+import gzip
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Buffered output for fastq and tsv report files. Records are collected as strings and
+written in large blocks, optionally compressed as gzip or BGZF.
+BGZF blocks are compressed independently, so they can be deflated by a pool of threads.
+"""
+
+BUFFER_SIZE = 4 * 1024 * 1024
+BGZF_BLOCK_SIZE = 65280
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+COMPRESSION_TYPES = ("none", "gzip", "bgzf")
+
+
+def bgzf_block(data, level=6):
+    """
+    Compress data into a single BGZF block
+
+    Parameters
+    ----------
+    data : bytes
+    uncompressed data, at most BGZF_BLOCK_SIZE bytes
+    level : int
+    zlib compression level
+
+    Returns
+    -------
+    block : bytes
+    gzip member with the BGZF 'BC' extra field
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    ## BSIZE is the total block size - 1 (18 byte header + 8 byte footer)
+    header = struct.pack("<4BI2BH2BHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25)
+    footer = struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+    return header + cdata + footer
+
+
+def infer_compression(filename):
+    """
+    Choose a compression type from the output file name ('.gz' is written as BGZF)
+
+    Parameters
+    ----------
+    filename : str
+    name of the file to be written
+
+    Returns
+    -------
+    compression : str
+    "bgzf" or "none"
+    """
+    if filename.endswith(".gz"):
+        return "bgzf"
+    return "none"
+
+
+class FastqWriter:
+    """
+    Buffered writer for fastq and tsv output, plain text, gzip, or BGZF compressed
+
+    Attributes
+    ----------
+    filename : name of the file written
+    compression : one of "none", "gzip", "bgzf"
+    buffer_size : number of characters collected before a block is written
+    """
+
+    def __init__(self, filename, compression=None, threads=0, level=6,
+                 buffer_size=BUFFER_SIZE, encoding="utf-8"):
+        """
+        Parameters
+        ----------
+        filename : str
+        name of the file to be written
+        compression : str
+        "none", "gzip" or "bgzf", inferred from the file name if None
+        threads : int
+        number of threads used to compress BGZF blocks (0 compresses inline)
+        level : int
+        zlib compression level
+        buffer_size : int
+        number of characters buffered before writing
+        encoding : str
+        text encoding of the output
+        """
+        if compression is None:
+            compression = infer_compression(filename)
+        if not compression in COMPRESSION_TYPES:
+            raise ValueError("compression must be one of {}".format(", ".join(COMPRESSION_TYPES)))
+        self.filename = filename
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.level = level
+        self.encoding = encoding
+        self.closed = False
+        self._chunks = []
+        self._size = 0
+        self._pool = None
+        self._pending = collections.deque()
+        self._max_pending = max(threads, 1) * 4
+        if compression == "gzip":
+            self._fh = gzip.open(filename, 'wb', compresslevel=level)
+        else:
+            self._fh = open(filename, 'wb')
+        if compression == "bgzf" and threads > 0:
+            self._pool = ThreadPoolExecutor(max_workers=threads)
+
+    def write(self, text):
+        """
+        Buffer text for writing, flushing a block when the buffer is full
+
+        Parameters
+        ----------
+        text : str
+        text to be written
+
+        Returns
+        -------
+        None
+        """
+        self._chunks.append(text)
+        self._size += len(text)
+        if self._size >= self.buffer_size:
+            self.flush()
+
+    def writelines(self, lines):
+        """
+        Buffer several strings for writing
+
+        Parameters
+        ----------
+        lines : iterable of str
+        text to be written
+
+        Returns
+        -------
+        None
+        """
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        """
+        Write all buffered text to the file
+
+        Returns
+        -------
+        None
+        """
+        if not self._chunks:
+            return
+        data = "".join(self._chunks).encode(self.encoding)
+        self._chunks = []
+        self._size = 0
+        if self.compression == "bgzf":
+            self._write_bgzf(data)
+        else:
+            self._fh.write(data)
+
+    def _write_bgzf(self, data):
+        for start in range(0, len(data), BGZF_BLOCK_SIZE):
+            block = data[start:(start + BGZF_BLOCK_SIZE)]
+            if self._pool is None:
+                self._fh.write(bgzf_block(block, self.level))
+                continue
+            ## keep blocks in order, writing finished blocks as the queue fills
+            self._pending.append(self._pool.submit(bgzf_block, block, self.level))
+            while len(self._pending) >= self._max_pending:
+                self._fh.write(self._pending.popleft().result())
+
+    def close(self):
+        """
+        Flush buffered text, write the BGZF EOF block and close the file
+
+        Returns
+        -------
+        None
+        """
+        if self.closed:
+            return
+        self.flush()
+        while self._pending:
+            self._fh.write(self._pending.popleft().result())
+        if self._pool is not None:
+            self._pool.shutdown()
+        if self.compression == "bgzf":
+            self._fh.write(BGZF_EOF)
+        self._fh.close()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
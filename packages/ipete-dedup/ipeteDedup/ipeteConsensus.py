@@ -1,13 +1,169 @@
-import collections
 import random
 from numpy import median
 from collections import Counter
 import math
+import multiprocessing
 from ipeteDedup.DNA_translate import DNA_translate
 ##from DNA_translate import DNA_translate
-import scipy.stats
+import scipy.special
+import numpy
 import pandas
 
+## bases counted for consensus, in the order ties are listed
+BASES = "ACTGN"
+BASE_CODES = numpy.full(256, -1, dtype=numpy.int64)
+for i, base in enumerate(BASES):
+    BASE_CODES[ord(base)] = i
+## log error probability of each Phred+33 quality character
+PHRED_LOG_P = numpy.log(numpy.array([10**(-(x - 33)/10) for x in range(256)]))
+
+def group_sums(values, starts, lengths):
+    """
+    Sum groups of consecutive values at once, adding values in the same order as numpy.sum (pairwise summation),
+    so each sum is identical to numpy.sum over the group. Consensus ties compare these sums exactly,
+    see group_sums_match_numpy for the check used before relying on them.
+
+    Parameters
+    ----------
+    values : numpy array
+    values of all groups
+    starts : numpy array
+    start of each group in values
+    lengths : numpy array
+    number of values in each group, at least one
+
+    Returns
+    -------
+    sums : numpy array
+    """
+    ## mirrors pairwise_sum in numpy/core/src/umath/loops.c.src (numpy/_core/src/umath/loops_utils.h.src
+    ## in newer releases): blocks of at most 128 (PW_BLOCKSIZE) values use 8 accumulators, larger blocks are split
+    ## in two at a multiple of 8
+    sums = numpy.zeros(len(starts))
+    def take(idx, mask):
+        return numpy.where(mask, values[numpy.where(mask, idx, 0)], -0.0)
+    ## fewer than 8 values are added in order
+    small = lengths < 8
+    if small.any():
+        s, n = starts[small], lengths[small]
+        res = numpy.full(len(s), -0.0)
+        for t in range(7):
+            res = res + take(s + t, t < n)
+        sums[small] = res
+    ## up to 128 values are added with 8 accumulators, then the remainder in order
+    mid = (lengths >= 8) & (lengths <= 128)
+    if mid.any():
+        s, n = starts[mid], lengths[mid]
+        blocks = n - n % 8
+        r = [values[s + k] for k in range(8)]
+        for i in range(8, 128, 8):
+            if not (i < blocks).any():
+                break
+            for k in range(8):
+                r[k] = r[k] + take(s + i + k, i < blocks)
+        res = ((r[0] + r[1]) + (r[2] + r[3])) + ((r[4] + r[5]) + (r[6] + r[7]))
+        for t in range(7):
+            res = res + take(s + blocks + t, t < n % 8)
+        sums[mid] = res
+    ## larger groups are split in two
+    large = lengths > 128
+    if large.any():
+        s, n = starts[large], lengths[large]
+        half = n // 2
+        half -= half % 8
+        sums[large] = group_sums(values, s, half) + group_sums(values, s + half, n - half)
+    return sums
+
+def group_sums_match_numpy(trials=500, seed=0):
+    """
+    Check group_sums against numpy.sum of each group on random values and group lengths,
+    the summation order of numpy.sum is an implementation detail that can change between releases
+
+    Returns
+    -------
+    bool : True if every group sum is identical
+    """
+    rng = numpy.random.RandomState(seed)
+    lengths = numpy.concatenate((numpy.arange(1, 300), rng.randint(1, 3000, trials)))
+    starts = numpy.cumsum(lengths) - lengths
+    values = numpy.log(rng.uniform(1e-12, 1, lengths.sum()))
+    sums = group_sums(values, starts, lengths)
+    return all(total == values[start:start + length].sum()
+               for total, start, length in zip(sums.tolist(), starts.tolist(), lengths.tolist()))
+
+## checked on first use, None until then
+GROUP_SUMS_EXACT = None
+
+def fisher_pvalues(logPVals, starts, lengths):
+    """
+    Combine groups of p-values with Fisher's method, as scipy.stats.combine_pvalues(group)[1] for each group
+
+    Parameters
+    ----------
+    logPVals : numpy array
+    natural log of the p-values of all groups
+    starts : numpy array
+    start of each group
+    lengths : numpy array
+    number of p-values in each group
+
+    Returns
+    -------
+    pvalues : numpy array
+    the combined p-value of each group
+    """
+    global GROUP_SUMS_EXACT
+    if GROUP_SUMS_EXACT is None:
+        GROUP_SUMS_EXACT = group_sums_match_numpy()
+    if GROUP_SUMS_EXACT:
+        sums = group_sums(logPVals, starts, lengths)
+    else:
+        ##numpy changed its summation order, sum each group on its own
+        sums = numpy.array([logPVals[start:start + length].sum() for start, length in zip(starts, lengths)])
+    statistic = -2 * sums
+    return scipy.special.chdtrc(2.0 * lengths, statistic)
+
+def family_rows(labels):
+    """
+    Group the rows of a table by UMI family with a single sort
+
+    Parameters
+    ----------
+    labels : pandas series
+    UMI_group label of each row
+
+    Returns
+    -------
+    families : list
+    (UMI_group, row positions) for each family, in order of first appearance. Rows keep their order in the table.
+    """
+    codes, groups = pandas.factorize(labels)
+    order = numpy.argsort(codes, kind="mergesort")
+    ends = numpy.cumsum(numpy.bincount(codes, minlength=len(groups)))
+    starts = ends - numpy.bincount(codes, minlength=len(groups))
+    return [(group, order[start:end]) for group, start, end in zip(groups.tolist(), starts, ends)]
+
+## consensus object and column values, set before worker processes are forked
+_CONSENSUS_STATE = {}
+
+def _consensus_chunk(families):
+    """
+    Define consensus for a chunk of UMI families in a forked worker, using the table inherited from the parent
+
+    Parameters
+    ----------
+    families : list
+    (UMI_group, row positions) of each family
+
+    Returns
+    -------
+    results : list
+    consensus of each column, for each family
+    """
+    consensus = _CONSENSUS_STATE["consensus"]
+    values = _CONSENSUS_STATE["values"]
+    return [consensus.family_consensus(group, rows, values) for group, rows in families]
+
 class ipeteConsensus(DNA_translate):
     """
     Define consensus for cdr3 and UMI sequences, using input from the deduping module.
@@ -56,7 +212,7 @@ class ipeteConsensus(DNA_translate):
             consensusAA = "_"
         return consensusAA
     
-    def df_consensus(self, umi_fam_df, seqCol, qualCol):
+    def df_consensus(self, umi_fam_df, seqCol, qualCol, families=None):
         """
         Given a df with UMI family labels, define consensus sequences and qualities
         for both UMI and CDR3 sequences found in the table
@@ -64,32 +220,91 @@ class ipeteConsensus(DNA_translate):
         ----------
         umi_fam_df :pandas DF
         dataframe with UMI group labels
+        families : list
+        rows of each UMI family (see family_rows), found from umi_fam_df if None
 
         Returns
         -------
         umi_fam_df :pandas DF
         dataframe with consensus information columns added        
         """
-        seqs = {}
-        results = []
-        UMI_groups = umi_fam_df.UMI_group.unique()        
-        for group in UMI_groups:
-            seqs[group] = []            
-            groupDF = umi_fam_df.loc[umi_fam_df["UMI_group"] == group]            
-            if not seqCol in groupDF.columns:
+        return self.families_consensus(umi_fam_df, [(seqCol, qualCol)], families)[seqCol]
+
+    def families_consensus(self, umi_fam_df, columns, families=None, processors=1):
+        """
+        Define consensus sequences and qualities for several sequence columns (e.g. cdr3, umi_r1 and umi_r2),
+        visiting each UMI family once. With more than one processor, families are split in chunks between forked
+        worker processes and results are returned in UMI_group order. Ties are broken with a random generator
+        seeded by each UMI_group, so results do not depend on the number of processors.
+
+        Parameters
+        ----------
+        umi_fam_df :pandas DF
+        dataframe with UMI group labels
+        columns : list
+        (sequence column, quality column) tuples
+        families : list
+        rows of each UMI family (see family_rows), found from umi_fam_df if None
+        processors : int
+        number of processes defining consensus
+
+        Returns
+        -------
+        consensus : dict
+        a dataframe of consensus_seq, consensus_qual and UMI_group for each sequence column
+        """
+        for seqCol, qualCol in columns:
+            if not seqCol in umi_fam_df.columns:
                 raise ValueError("column name {} not found".format(seqCol))
-            if not qualCol in groupDF.columns:
+            if not qualCol in umi_fam_df.columns:
                 raise ValueError("column name {} not found".format(qualCol))            
-            for seq, qual in zip(groupDF[seqCol],
-                                 groupDF[qualCol]):
-                seqs[group].append((seq,qual))
-            consensus = self.define_consensus(seqs[group])
+        if families is None:
+            families = family_rows(umi_fam_df["UMI_group"])
+        values = [(umi_fam_df[seqCol].to_numpy(), umi_fam_df[qualCol].to_numpy()) for seqCol, qualCol in columns]
+        if processors > 1 and len(families) > 1:
+            ##several chunks per process, to balance the load
+            n = max(len(families) // (processors * 8), 1)
+            chunks = [families[i:(i + n)] for i in range(0, len(families), n)]
+            _CONSENSUS_STATE["consensus"] = self
+            _CONSENSUS_STATE["values"] = values
+            familyResults = []
+            try:
+                with multiprocessing.get_context("fork").Pool(processes=processors) as pool:
+                    ## imap returns chunks in order
+                    for chunkResults in pool.imap(_consensus_chunk, chunks):
+                        familyResults.extend(chunkResults)
+            finally:
+                _CONSENSUS_STATE.clear()
+        else:
+            familyResults = [self.family_consensus(group, rows, values) for group, rows in families]
+        return {seqCol: pandas.DataFrame([x[i] for x in familyResults]) for i, (seqCol, _) in enumerate(columns)}
+
+    def family_consensus(self, group, rows, values):
+        """
+        Define consensus of each column for one UMI family, breaking ties with a random generator seeded by UMI_group
+
+        Parameters
+        ----------
+        group : UMI_group label of the family
+        rows : numpy array
+        row positions of the family
+        values : list
+        (sequences, qualities) arrays of each column
+
+        Returns
+        -------
+        results : list
+        consensus of each column
+        """
+        rng = random.Random(group)
+        results = []
+        for seqs, quals in values:
+            consensus = self.define_consensus(list(zip(seqs[rows], quals[rows])), rng=rng)
             consensus["UMI_group"] = group
             results.append(consensus)
-        conDF = pandas.DataFrame(results)
-        return conDF        
+        return results
             
-    def define_consensus(self, seqTups, debug=False):
+    def define_consensus(self, seqTups, debug=False, rng=random):
         """
         Given a list of tuples with the format '(string, quality)' define consensus of the string... guided by quality scores
         
@@ -97,6 +312,8 @@ class ipeteConsensus(DNA_translate):
         ----------
         seqTups : list of tuples
         A list of tuples, where each tuple contains a string and quality scores
+        rng : random.Random
+        random generator choosing between tied bases, the random module by default
 
         Returns
         -------
@@ -105,8 +322,6 @@ class ipeteConsensus(DNA_translate):
         consensus : dict 
         dictionary containing consensus information. Sequence, quality, and stats
         """
-        baseQuals = collections.OrderedDict()
-        baseCounts = collections.OrderedDict()
         family_size = len(seqTups)
         #####################
         # first filter reads
@@ -135,97 +350,65 @@ class ipeteConsensus(DNA_translate):
         ###################################################
         # otherwise, find consensus by weighing base-pairs
         ###################################################
-        for seq in compress:
-            seqCount = len(compress[seq])
-            # count the frequency of each base
-            quals = compress[seq]
-            ##parse quality values from string
-            pVals = {}
-            for qual in quals:
-                for pos, q, in enumerate(qual):
-                    if not pos in pVals:
-                        pVals[pos] = []
-                    qVal = ord(q) - 33
-                    pVal = 10**(-qVal/10)
-                    pVals[pos].append(pVal)                    
-            ##sum quality values
-            for pos, base in enumerate(seq):
-                if not pos in baseCounts:
-                    baseQuals[pos] = {"A": [], "C": [], "T": [], "G": [], "N": []}
-                    baseCounts[pos] = {"A": 0, "C": 0, "T": 0, "G": 0, "N": 0}    
-                baseQuals[pos][base] += pVals[pos]
-                baseCounts[pos][base] += len(quals)
+        ## reads of each compressed seq, in order. Quality strings are cut to the sequence length.
+        seqLen = len(compressCounts[0][0])
+        reads = [(seq, qual[:seqLen]) for seq in compress for qual in compress[seq]]
+        if any(len(qual) < seqLen for _, qual in reads):
+            raise ValueError("quality string shorter than sequence")
+        baseCodes = BASE_CODES[numpy.frombuffer("".join(x[0] for x in reads).encode(), dtype=numpy.uint8)]
+        if (baseCodes < 0).any():
+            raise ValueError("bases must be one of {}".format(BASES))
+        qualCodes = numpy.frombuffer("".join(x[1] for x in reads).encode(), dtype=numpy.uint8)
+        ## group quality values by (position, base), keeping read order within each group
+        keys = (baseCodes.reshape(len(reads), seqLen).T + numpy.arange(seqLen)[:, None] * len(BASES)).ravel()
+        order = numpy.argsort(keys, kind="mergesort")
+        logPVals = PHRED_LOG_P[qualCodes.reshape(len(reads), seqLen).T.ravel()[order]]
+        ## coverage of each base
+        baseCounts = numpy.bincount(keys, minlength=seqLen * len(BASES))
+        starts = numpy.cumsum(baseCounts) - baseCounts
         ##combine pvalues for each base
-        basePVals = {}
-        for pos in baseQuals:
-            basePVals[pos] = {"A": 0, "C": 0, "T": 0, "G": 0, "N": 0}
-            for base in baseQuals[pos]:
-                if len(baseQuals[pos][base]) > 0:
-                    pValue = scipy.stats.combine_pvalues(baseQuals[pos][base])[1]
-                    if pValue > 0.63:
-                        pValue = 0.63
-                    basePVals[pos][base] = pValue                    
-                else:
-                    basePVals[pos][base] = 1
+        covered = baseCounts > 0
+        basePVals = numpy.ones(seqLen * len(BASES))
+        basePVals[covered] = numpy.minimum(fisher_pvalues(logPVals, starts[covered], baseCounts[covered]), 0.63)
+        basePVals = basePVals.reshape(seqLen, len(BASES))
+        baseCounts = baseCounts.reshape(seqLen, len(BASES))
 
         ##################################
         # determine best base per position
         ##################################
-        forConsensus = []
+        ##minVal == lowest P-value, bases with the lowest P-value are choices
+        isChoice = basePVals == basePVals.min(axis=1)[:, None]
+        ## choose highest coverage otherwise
+        choiceCounts = numpy.where(isChoice, baseCounts, -1)
+        isMaxCov = isChoice & (choiceCounts == choiceCounts.max(axis=1)[:, None])
+        tied = isMaxCov.sum(axis=1) > 1
+        ## first base with the lowest P-value and highest coverage, in A, C, T, G, N order
+        maxBases = numpy.argmax(isMaxCov, axis=1)
+        ################################################
+        # if more than one maximum, randomly choose one
+        ################################################
+        for pos in numpy.flatnonzero(tied):
+            choices = numpy.flatnonzero(isChoice[pos])
+            maxBases[pos] = choices[rng.randint(0, len(choices)-1)]
+        ###############################
+        ## calculate consensus quality
+        ###############################
+        ##if more than one choice existed, the quality is set to 2 for that position
         forQual = []
-        for pos in baseCounts:
-            baseVals = sorted(basePVals[pos].items(), key=lambda x: x[1])            
-            ##minVal == lowest P-value
-            minVal = min([x[1] for x in baseVals])
-            choices = []
-            for base, val in baseVals:
-                if val == minVal:
-                    choices.append(base)
-            maxBase = ""            
-            ################################################
-            # if more than one maximum, randomly choose one
-            ################################################
-            if len(choices) > 1:                
-                ## choose highest coverage otherwise
-                toChoose = []
-                #####################################
-                ## filter by coverage if equal pvalue
-                #####################################
-                maxCov = 0
-                for choice in choices:
-                    cov = baseCounts[pos][choice]
-                    if cov > maxCov:
-                        maxCov = cov
-                    toChoose.append({"base": choice, "cov": cov})
-                toChoose = [x for x in toChoose if x["cov"] == maxCov]
-                if len(toChoose) > 1:
-                    maxBase = choices[random.randint(0, len(choices)-1)]                    
-                else:                    
-                    maxBase = toChoose[0]["base"]
-                    choices = [maxBase]
-            else:
-                maxBase = choices[0]
-            forConsensus.append(maxBase)
-            ###############################
-            ## calculate consensus quality
-            ###############################
-            ##if more than one choice existed, the quality is set to 2 for that position
-            if len(choices) > 1:
+        for basePVal, isTied in zip(basePVals[numpy.arange(seqLen), maxBases].tolist(), tied.tolist()):
+            if isTied:
                 forQual.append(2)
+            elif basePVal <= 0.000001:
+                forQual.append(60)
             else:
-                basePVal = basePVals[pos][maxBase]
-                if basePVal <= 0.000001:
-                    baseQVal = 60
-                else:
-                    baseQVal = int(-10*math.log10(basePVal))
-                    if baseQVal == 0:
-                        raise ValueError("error {}".format(len(basePVal)))                        
+                baseQVal = int(-10*math.log10(basePVal))
+                if baseQVal == 0:
+                    raise ValueError("error {}".format(basePVal))                        
                 forQual.append(baseQVal)            
         #############################
         ##calculate consensus quality
         #############################
-        consensusSeq = "".join(forConsensus)
-        consensusQual=""
+        consensusSeq = "".join(BASES[x] for x in maxBases.tolist())
         consensusQual = "".join([chr(x+33) for x in forQual])
         consensus = {"consensus_seq":consensusSeq,
                      "consensus_qual":consensusQual}
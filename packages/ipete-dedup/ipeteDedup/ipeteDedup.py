@@ -5,11 +5,18 @@ from ipeteDedup.getLogger import getLogger
 ##from getLogger import getLogger
 import collections
 from SeqNetwork import SeqNetwork
-from ipeteDedup.ipeteConsensus import ipeteConsensus
+from ipeteDedup.ipeteConsensus import ipeteConsensus, family_rows
 ##from ipeteConsensus import ipeteConsensus
 import Levenshtein
+import numpy
 import os
 
+## columns of the alignment report used for the graph, consensus and UMI family reports
+GENE_COLUMNS = ["v_gene", "v_locus_type", "v_idb_type", "j_gene", "j_locus_type", "j_idb_type"]
+DEDUP_COLUMNS = ["name", "cdr3", "cdr3_qual", "avg_read_qual",
+                 "umi_r1", "umi_r1_qual", "umi_r2", "umi_r2_qual"] + GENE_COLUMNS
+CHUNK_SIZE = 100000
+
 def filter_reads(aln_df, params):
     """
     Filter a pandas dataframe (df) against a set of given parameters (params)
@@ -93,7 +100,69 @@ def add_dimensions(aln_df, graph, params):
             graph.add_dimension("UMI_R2", rid, umi2, params["umi_dist"])
         graph.add_dimension("CDR3", rid, cdr3, params["cdr3_dist"])
     return graph
-    
+
+def read_dedup_columns(alnFile, params, graph, chunksize=CHUNK_SIZE):
+    """
+    Read the alignment report in chunks, adding filtered reads to the graph.
+    Only the columns used for deduping are kept, with categorical gene columns.
+
+    Parameters
+    ----------
+    alnFile : tsv file
+    alignment report returned by VDJdetector and with UMIs from extract-umi
+    params : dict
+    A dictionary of parameters to be filtered against
+    graph : SeqNetwork instance
+    An instance of SeqNetwork, used for building string similarity networks
+    chunksize : int
+    number of rows read at a time
+
+    Returns
+    -------
+    reads : pandas dataframe
+    filtered reads, indexed by their row number in alnFile
+    total_reads : int
+    number of reads in alnFile
+    """
+    chunks = []
+    total_reads = 0
+    for chunk in pandas.read_csv(alnFile, chunksize=chunksize, sep="\t", usecols=lambda x: x in DEDUP_COLUMNS):
+        total_reads += chunk.shape[0]
+        filt = filter_reads(chunk, params)
+        filt = check_umi_columns(filt, params)
+        graph = add_dimensions(filt, graph, params)
+        chunks.append(filt)
+    ## share gene categories between chunks, so the columns stay categorical when joined
+    for col in GENE_COLUMNS:
+        categories = pandas.unique(numpy.concatenate([chunk[col].dropna().unique().astype(object) for chunk in chunks]))
+        for chunk in chunks:
+            chunk[col] = pandas.Categorical(chunk[col], categories=categories)
+    return pandas.concat(chunks), total_reads
+
+def write_labeled_reads(alnFile, row_labels, out_file, chunksize=CHUNK_SIZE):
+    """
+    Stream the alignment report a second time, writing reads in UMI families with their UMI_group label.
+    Values are copied from alnFile as text.
+
+    Parameters
+    ----------
+    alnFile : tsv file
+    alignment report returned by VDJdetector and with UMIs from extract-umi
+    row_labels : numpy array
+    UMI_group of each row in alnFile, 0 for reads not in a UMI family
+    out_file : str
+    path of the labeled read report
+    chunksize : int
+    number of rows read at a time
+    """
+    header = True
+    for chunk in pandas.read_csv(alnFile, chunksize=chunksize, sep="\t", dtype=str, keep_default_na=False):
+        labels = row_labels[chunk.index.values]
+        labeled = chunk[labels > 0].copy()
+        labeled["UMI_group"] = labels[labels > 0]
+        labeled.to_csv(out_file, sep="\t", index=False, header=header, mode="w" if header else "a")
+        header = False
+
 def ipete_dedup(alnFile, params, basename, logger):
     """
     Takes alignment file with parameters and produces dedup report files and logs progress
@@ -116,41 +185,42 @@ def ipete_dedup(alnFile, params, basename, logger):
     """
     dedup_output = "{}_on_target_umi_groups.tsv".format(basename)
     dedup_report_file = "{}_cdr3_dedup_report.tsv".format(basename)
-    ## read file in chunks
-    chunksize = 100000    
     ## instatiate graph
-    graph = SeqNetwork.SeqNetwork()
+    graph = SeqNetwork.SeqNetwork(processors=params["processors"])
     consensus = ipeteConsensus()
-    ## add dimensions to graph
+    ## add dimensions to graph, keeping the columns needed for consensus
     logger.info("add dimensions...")
-    for chunk in pandas.read_csv(alnFile, chunksize=chunksize, sep="\t"):        
-        filt = filter_reads(chunk, params)        
-        filt = check_umi_columns(filt, params)                    
-        graph = add_dimensions(filt, graph, params)
+    filtered, total_reads = read_dedup_columns(alnFile, params, graph)
     ##build the graph
     logger.info("build graph...")
     graph.build_graph()
     ##cluster
     logger.info("partition graph...")
-    graph.remove_edges(params["max_steps"], params["bidding_ratio"])
+    graph.remove_edges(params["max_steps"], params["bidding_ratio"], streaming=params["low_memory"])
     ## define UMI family labels
-    logger.info("define UMI families...")
-    families = graph.collapse_graph()
-    logger.info("label UMI families...")
-    family_labels = graph.retreive_read_labels(families)
-    ####################################
-    ## read entire file, label families
-    ####################################
-    aln_df = pandas.read_csv(alnFile, sep="\t")
-    filtered = aln_df[aln_df["name"].isin(list(family_labels.keys()))].copy(deep=True)
+    logger.info("define and label UMI families...")
+    family_labels = pandas.Series(graph.read_family_labels(), index=graph.read_names)
+    #####################################
+    ## label families, stream read report
+    #####################################
+    filtered = filtered[filtered["name"].isin(family_labels.index)].copy()
     filtered["UMI_group"] = filtered["name"].map(family_labels)
-    filtered.to_csv(dedup_output, sep="\t", index=False)
+    row_labels = numpy.zeros(total_reads, dtype=numpy.int64)
+    row_labels[filtered.index.values] = filtered["UMI_group"].values
+    write_labeled_reads(alnFile, row_labels, dedup_output)
     ##filtered = consensus.define_UMI_CDR3_consensus(filtered)
     ################################
     ## consensus and summary report
     ################################
-    umi_summary = umi_group_report(filtered, params)    
-    cdr3Consensus = consensus.df_consensus(filtered, "cdr3", "cdr3_qual")        
+    families = family_rows(filtered["UMI_group"])
+    umi_summary = umi_group_report(filtered, params, families)    
+    consensusColumns = [("cdr3", "cdr3_qual")]
+    if params["umi_read1"] is True:
+        consensusColumns.append(("umi_r1", "umi_r1_qual"))
+    if params["umi_read2"] is True:
+        consensusColumns.append(("umi_r2", "umi_r2_qual"))
+    consensi = consensus.families_consensus(filtered, consensusColumns, families, params["processors"])
+    cdr3Consensus = consensi["cdr3"]
     ##cdr3Consensus.rename(columns={"consensus_seq":"cdr3_AA", "consensus_qual":"cdr3_qual"}) 
     umi_summary["cdr3"] = cdr3Consensus["consensus_seq"]
     umi_summary["cdr3_AA"] = umi_summary["cdr3"].apply(consensus.translate_cdr3)
@@ -158,12 +228,12 @@ def ipete_dedup(alnFile, params, basename, logger):
     umi_summary["cdr3_minQual"] = cdr3Consensus["consensus_qual"].apply(qualMin)
     ##rename columns    
     if params["umi_read1"] is True:
-        umi1Consensus = consensus.df_consensus(filtered, "umi_r1", "umi_r1_qual")
+        umi1Consensus = consensi["umi_r1"]
         umi_summary["UMI_R1"] = umi1Consensus["consensus_seq"]
         umi_summary["UMI_R1_qual"] = umi1Consensus["consensus_qual"]
         umi_summary["UMI_R1_minQual"] = cdr3Consensus["consensus_qual"].apply(qualMin)
     if params["umi_read2"] is True:
-        umi2Consensus = consensus.df_consensus(filtered, "umi_r2", "umi_r2_qual")
+        umi2Consensus = consensi["umi_r2"]
         umi_summary["UMI_R2"] = umi2Consensus["consensus_seq"]
         umi_summary["UMI_R2_qual"] = umi2Consensus["consensus_qual"]
         umi_summary["UMI_R2_minQual"] = cdr3Consensus["consensus_qual"].apply(qualMin)
@@ -172,7 +242,7 @@ def ipete_dedup(alnFile, params, basename, logger):
     umi_summary["cummulative_reads"] = umi_summary["UMI_family_size"].cumsum()
     umi_summary["cummulative_fraction"] = umi_summary["cummulative_reads"] / sum(umi_summary["UMI_family_size"])
     umi_summary.to_csv(dedup_report_file, sep="\t", index=False)
-    summarize(aln_df, umi_summary, graph, logger)
+    summarize(total_reads, umi_summary, graph, logger)
     
 def qualMin(qualString):
     minQual = 60
@@ -183,21 +253,69 @@ def qualMin(qualString):
             minQual = qVal
     return minQual
 
-def umi_group_report(umi_fam_df, params):
+def factorize_column(values):
+    """
+    Code the values of a column as integers, in order of first appearance
+
+    Parameters
+    ----------
+    values : pandas series
+    column values, object or categorical
+
+    Returns
+    -------
+    codes : numpy array
+    the code of each value, missing values are coded as one more value
+    uniques : list
+    the value of each code, NaN for missing values
+    """
+    codes, uniques = pandas.factorize(values)
+    codes[codes < 0] = len(uniques)
+    return codes, list(uniques) + [numpy.nan]
+
+def most_common(codes, uniques):
+    """
+    Find the most common value in coded column values (see factorize_column), ties go to the value seen first
+
+    Returns
+    -------
+    value : the most common value
+    total : int
+    number of distinct values
+    """
+    found, first, counts = numpy.unique(codes, return_index=True, return_counts=True)
+    top = numpy.flatnonzero(counts == counts.max())
+    return uniques[found[top[numpy.argmin(first[top])]]], len(found)
+
+def umi_group_report(umi_fam_df, params, families=None):
     """
     given a VDJ report table with UMI_group labels, generate V-J gene stats by UMI family
+
+    Parameters
+    ----------
+    umi_fam_df : pandas dataframe
+    reads with UMI_group labels
+    params : dict
+    A dictionary of parameters to be filtered against
+    families : list
+    rows of each UMI family (see ipeteConsensus.family_rows), found from umi_fam_df if None
     """
+    if families is None:
+        families = family_rows(umi_fam_df["UMI_group"])
+    ## gene columns are coded once, families count codes over their rows
+    genes = {col: factorize_column(umi_fam_df[col]) for col in GENE_COLUMNS}
+    def family_gene(col, rows):
+        codes, uniques = genes[col]
+        return most_common(codes[rows], uniques)
     family_report = []
-    UMI_groups = umi_fam_df.UMI_group.unique()        
-    for group in UMI_groups:
-        groupDF = umi_fam_df.loc[umi_fam_df["UMI_group"] == group]            
-        family_size = groupDF.shape[0]
-        Vgenes = groupDF["v_gene"].value_counts(dropna=False)
-        VGeneType = groupDF["v_locus_type"].value_counts(dropna=False)            
-        VIdbType = groupDF["v_idb_type"].value_counts(dropna=False)            
-        Jgenes = groupDF["j_gene"].value_counts(dropna=False)
-        JGeneType = groupDF["j_locus_type"].value_counts(dropna=False)            
-        JIdbType = groupDF["j_idb_type"].value_counts(dropna=False)                
+    for group, rows in families:
+        family_size = len(rows)
+        Vgene, multiV = family_gene("v_gene", rows)
+        VGeneType, _ = family_gene("v_locus_type", rows)
+        VIdbType, _ = family_gene("v_idb_type", rows)
+        Jgene, multiJ = family_gene("j_gene", rows)
+        JGeneType, _ = family_gene("j_locus_type", rows)
+        JIdbType, _ = family_gene("j_idb_type", rows)
         family_report.append(
             collections.OrderedDict({"cdr3_AA" : "",
                                      "UMI_family_size" : family_size,
@@ -210,22 +328,22 @@ def umi_group_report(umi_fam_df, params):
                                      "cdr3" : "",
                                      "cdr3_qual" : "",
                                      "cdr3_minQual" : None,
-                                     "Vgene" : Vgenes.idxmax(),
-                                     "Jgene" : Jgenes.idxmax(),
-                                     "multiV" : len(Vgenes),
-                                     "multiJ" : len(Jgenes),
-                                     "V_GeneType" : VGeneType.idxmax(),
-                                     "V_IdbType" : VIdbType.idxmax(),
-                                     "J_GeneType" : JGeneType.idxmax(),
-                                     "J_IdbType" : JIdbType.idxmax(),
+                                     "Vgene" : Vgene,
+                                     "Jgene" : Jgene,
+                                     "multiV" : multiV,
+                                     "multiJ" : multiJ,
+                                     "V_GeneType" : VGeneType,
+                                     "V_IdbType" : VIdbType,
+                                     "J_GeneType" : JGeneType,
+                                     "J_IdbType" : JIdbType,
                                      "UMI_group" : group
             })
         )
     return pandas.DataFrame(family_report)
     
 
-def summarize(aln_df, umi_summary, graph, logger):
-    logger.info("on target reads = {}".format( aln_df.shape[0] ))
+def summarize(total_reads, umi_summary, graph, logger):
+    logger.info("on target reads = {}".format( total_reads ))
     logger.info("filtered reads = {}".format( sum(umi_summary["UMI_family_size"]) ))        
     dimensions = list(graph.dimensions.keys())
     logger.info("number of dimensions = {}".format(len(graph.dimensions)))
@@ -285,6 +403,11 @@ def main():
                         type=int,
                         default=1,
                         help="number of processors used for deduping")
+    parser.add_argument("-m", "--low_memory",
+                        required=False,
+                        action='store_true',
+                        default = False,
+                        help="keep only the best bid for each node while partitioning the graph, walking the graph twice")
     parser.add_argument("-o", "--out_basename",
                         required=True,
                         help="basename for output summary reports: read report, cdr3 consensus report and umi-cdr3 node report")
@@ -301,6 +424,7 @@ def main():
         "bidding_ratio" : args.bidding_ratio,
         "max_steps" : args.steps,
         "processors" : args.processors,        
+        "low_memory" : args.low_memory,
         "umi_read1" : args.umi_read1,
         "umi_read2" : args.umi_read2
     }
@@ -0,0 +1,196 @@
+import collections
+import numpy as np
+
+"""
+NumPy kernels for clone diversity and entropy measures.
+Clone counts are given as a 1-D array for one sample, or as a 2-D array with one row of counts per sample (or chain),
+padded with zeros (see count_matrix). Every function reduces over the last axis, returning a value for each row.
+Samples without any counts have richness 0, every other measure is nan for them.
+"""
+
+RENYI_ORDERS = (0, 1, 2, np.inf)
+
+
+def count_array(vals):
+    """
+    Clone counts (list, dict values, pandas Series or array) as a float array
+    """
+    try:
+        return np.asarray(vals, dtype=float)
+    except TypeError:
+        return np.fromiter(vals, dtype=float)
+
+
+def count_matrix(groups):
+    """
+    Stack the clone counts of several samples into a 2-D array, one row per sample, padded with zeros
+
+    Parameters
+    ----------
+    groups : list
+    clone counts of each sample
+
+    Returns
+    -------
+    counts : numpy array
+    """
+    groups = [count_array(x) for x in groups]
+    counts = np.zeros((len(groups), max([len(x) for x in groups], default=0)))
+    for i, vals in enumerate(groups):
+        counts[i, :len(vals)] = vals
+    return counts
+
+
+def frequencies(counts):
+    """
+    Fraction of each sample held by every clone
+    """
+    counts = count_array(counts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return counts / counts.sum(axis=-1, keepdims=True)
+
+
+def richness(counts):
+    """
+    Number of clones in each sample
+    """
+    return np.count_nonzero(count_array(counts), axis=-1)
+
+
+def with_counts(counts, values):
+    """
+    Replace the values of samples without any counts by nan
+    """
+    return np.where(richness(counts) > 0, values, np.nan)
+
+
+def entropy_norm(counts):
+    """
+    Maximum entropy (log2 of the number of clones) used to normalize entropies, 1 for samples with a single clone
+    """
+    unique = richness(counts)
+    return np.where(unique > 1, np.log2(np.maximum(unique, 1)), 1.0)
+
+
+def renyi(counts, order, normalize=False):
+    """
+    Renyi entropy (log2) of clone counts
+
+    Parameters
+    ----------
+    counts : numpy array
+    clone counts, 1-D or 2-D
+    order : float
+    order of the entropy (alpha), 0 is the Hartley entropy, 1 the Shannon entropy, 2 the collision entropy
+    and inf the min-entropy, -log2 of the largest clone frequency
+    normalize : bool
+    divide by log2 of the number of clones
+
+    Returns
+    -------
+    entropy : float or numpy array
+    """
+    order = float(order)
+    if order < 0:
+        raise ValueError("Renyi entropy order must be >= 0")
+    counts = count_array(counts)
+    freqs = frequencies(counts)
+    present = counts > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if order == 0:
+            entropy = np.log2(richness(counts))
+        elif order == 1:
+            entropy = -np.sum(np.where(present, freqs * np.log2(np.where(present, freqs, 1)), 0), axis=-1)
+        elif order == np.inf:
+            ##max of an empty last axis raises, those samples are set to nan below
+            entropy = -np.log2(freqs.max(axis=-1) if freqs.shape[-1] else np.zeros(freqs.shape[:-1]))
+        else:
+            entropy = np.log2(np.sum(np.where(present, freqs ** order, 0), axis=-1)) / (1 - order)
+    if normalize:
+        entropy = entropy / entropy_norm(counts)
+    return with_counts(counts, entropy)
+
+
+def simpsons_diversity(counts):
+    """
+    Simpsons diversity index, 1 - probability that two UMI families drawn without replacement share a clone.
+    0 for samples with at most one UMI family
+    """
+    counts = count_array(counts)
+    total = counts.sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        index = 1 - np.sum(counts * (counts - 1), axis=-1) / (total * (total - 1))
+    return with_counts(counts, np.where(total > 1, index, 0.0))
+
+
+def simpsons_dominance(counts):
+    """
+    Simpsons dominance index, sum of squared clone frequencies
+    """
+    counts = count_array(counts)
+    return with_counts(counts, np.sum(frequencies(counts) ** 2, axis=-1))
+
+
+def gini(counts):
+    """
+    Gini coefficient of the clone counts, 1 for samples with less than two clones
+    """
+    counts = np.sort(count_array(counts), axis=-1)
+    unique = richness(counts)
+    total = counts.sum(axis=-1)
+    ##zero padding sorts first, shift the ranks of the clones past it
+    padding = counts.shape[-1] - unique
+    weighted = np.sum(counts * np.arange(1, counts.shape[-1] + 1), axis=-1) - padding * total
+    with np.errstate(divide='ignore', invalid='ignore'):
+        index = 2 * weighted / (unique * total) - (unique + 1) / unique
+    return with_counts(counts, np.where(unique < 2, 1.0, index))
+
+
+def d50(counts):
+    """
+    Fraction of clones, largest first, holding at least half of the UMI families
+    """
+    counts = -np.sort(-count_array(counts), axis=-1)
+    ##argmax of an empty last axis raises
+    if counts.shape[-1] == 0:
+        return np.full(counts.shape[:-1], np.nan)
+    reached = 2 * np.cumsum(counts, axis=-1) >= counts.sum(axis=-1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return with_counts(counts, (np.argmax(reached, axis=-1) + 1) / richness(counts))
+
+
+def order_name(order):
+    return "inf" if np.isinf(order) else "{:g}".format(order)
+
+
+def diversity_indices(counts, orders=RENYI_ORDERS):
+    """
+    Calculate all diversity and entropy measures of clone counts in one call
+
+    Parameters
+    ----------
+    counts : numpy array
+    clone counts of one sample (1-D), or one row per sample (2-D, see count_matrix) to score many samples at once
+    orders : list
+    Renyi entropy orders to report
+
+    Returns
+    -------
+    indices : OrderedDict
+    measure name to value, floats for 1-D counts or an array with a value for each row of 2-D counts
+    """
+    counts = count_array(counts)
+    norm = entropy_norm(counts)
+    indices = collections.OrderedDict()
+    indices["unique"] = richness(counts)
+    indices["simpsons_diversity_index"] = simpsons_diversity(counts)
+    indices["simpsons_dominance_index"] = simpsons_dominance(counts)
+    for order in orders:
+        indices["renyi_{}".format(order_name(order))] = renyi(counts, order)
+    for order in orders:
+        indices["renyi_{}_norm".format(order_name(order))] = indices["renyi_{}".format(order_name(order))] / norm
+    indices["gini_index"] = gini(counts)
+    indices["D50"] = d50(counts)
+    if counts.ndim == 1:
+        indices = collections.OrderedDict((name, np.asarray(vals).tolist()) for name, vals in indices.items())
+    return indices
@@ -13,6 +13,7 @@ for all rearrangements and all functional rearrangements
 
 def get_ipete_metrics(report_file, basename):
     ipeteDF = import_cdr3_report(report_file)
+    ipeteDF["clone_id"] = clone_ids(ipeteDF)
     functDF = get_functional(ipeteDF)
     ipeteStats = diversity_stats(ipeteDF)
     functStats = diversity_stats(functDF)    
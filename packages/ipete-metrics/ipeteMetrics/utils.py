@@ -4,6 +4,7 @@ import collections
 import math
 import numpy as np
 import re
+from ipeteMetrics import diversity
 
 """
 renyi_0 : Hartley/max entropy
@@ -12,62 +13,39 @@ renyi_2 : Collision entropy
 renyi_inf : Min-entropy
 """
 
+##UMI families with the same genes and cdr3 sequence belong to one clone
+CLONE_COLUMNS = ['Vgene', 'cdr3', 'Jgene']
+
 def calc_freq(vals):
-    freqs = []
-    total = float(sum(vals))
-    for val in vals:
-        prob = float(val/total)
-        freqs.append(prob)
-    return freqs
+    return diversity.frequencies(vals).tolist()
 
 def gini(arr):
     if len(arr) < 2:
         return(1)
-    ## first sort
-    arr = np.array(arr)
-    sorted_arr = arr.copy()
-    sorted_arr.sort()
-    n = arr.size
-    coef_ = 2. / n
-    const_ = (n + 1.) / n
-    weighted_sum = sum([(i+1)*yi for i, yi in enumerate(sorted_arr)])
-    return coef_*weighted_sum/(sorted_arr.sum()) - const_
+    return float(diversity.gini(arr))
 
 def shannon_entropy(vals):
     """
     Calculate Shannon Entropy for a set of values
     """
     ## vals represent cdr3 counts
-    calcs = []
-    freqs = calc_freq(vals)
-    for freq in freqs:
-        calcs.append(freq * math.log2(freq))
-    return sum(calcs) * -1
+    return float(diversity.renyi(vals, 1))
 
 def renyi_calc(vals, alpha):
     """
     Calculate Shannon Entropy for a set of values
     """
     ## vals represent cdr3 counts
-    calcs = []
-    freqs = calc_freq(vals)
-    for freq in freqs:
-        calcs.append(math.pow(freq,alpha))    
-    return (1/(1-alpha)) * math.log2(sum(calcs))
+    return float(diversity.renyi(vals, alpha))
 
 def simpsons_diversity_index(vals):
     """
     Calculate Simpsons Diveristy for a set of values
     """
     ## vals represent cdr3 counts
-    total = float(sum(vals))
-    if total <= 1:
+    if sum(vals) <= 1:
         return 0
-    multp = []
-    for val in vals:
-        multp.append(val * (val-1))
-    simpsons =  sum(multp) / ( total * (total - 1) )
-    return 1 - simpsons
+    return float(diversity.simpsons_diversity(vals))
 
 def simpsons_dominance_index(vals):
     """
@@ -78,9 +56,7 @@ def simpsons_dominance_index(vals):
     vals : list
     list of float values
     """
-
-    total = float(sum(vals))
-    return sum([float(x/total)**2 for x in vals])
+    return float(diversity.simpsons_dominance(vals))
 
 def renyi_entropy(vals, alpha=1, normalize = False):
     """
@@ -123,30 +99,7 @@ def calc_D50(vals):
     D50 : float
     fraction of clones containing the top 50% of all UMI families        
     """
-    sortVals = sorted(vals, key = lambda x: -x)
-    mid = sum(sortVals)/2
-    tot = 0
-    D50 = 0
-    for x in sortVals:
-        D50 += 1
-        tot += x
-        if tot >= mid:
-            break
-    return float(D50 / len(sortVals))
-
-
-def gini(arr):
-    if len(arr) < 2:
-        return(1)
-    ## first sort
-    arr = np.array(arr)
-    sorted_arr = arr.copy()
-    sorted_arr.sort()
-    n = arr.size
-    coef_ = 2. / n
-    const_ = (n + 1.) / n
-    weighted_sum = sum([(i+1)*yi for i, yi in enumerate(sorted_arr)])
-    return coef_*weighted_sum/(sorted_arr.sum()) - const_
+    return float(diversity.d50(vals))
 
 
 def import_cdr3_report(report_file):
@@ -160,75 +113,183 @@ def get_functional(df):
     funDF = funDF.reset_index()
     return funDF
 
-def run_calc(sliceDF):    
-    sliceDF['cdr3Id'] = sliceDF[['Vgene', 'cdr3', 'Jgene']].apply(lambda x: '_'.join(str(x)), axis=1)
-    sliceCDR3 = sliceDF["cdr3Id"].value_counts().to_dict()
+def clone_ids(df):
+    """
+    Integer clone id of each UMI family, from its (Vgene, cdr3, Jgene), numbered in order of first appearance.
+    Missing genes are kept as their own value.
+
+    Parameters
+    ----------
+    df : pandas dataframe
+    cdr3 dedup report
+
+    Returns
+    -------
+    clones : numpy array
+    """
+    clones = np.zeros(df.shape[0], dtype=np.int64)
+    for column in CLONE_COLUMNS:
+        codes, uniques = pandas.factorize(df[column])
+        ##renumber after each column, keeping the combined codes below the number of rows
+        clones = pandas.factorize(clones * (len(uniques) + 1) + codes + 1)[0]
+    return clones
+
+def report_clone_ids(df):
+    """
+    clone ids of a report, reusing the clone_id column when it was already added
+    """
+    if "clone_id" in df.columns:
+        return df["clone_id"].values
+    return clone_ids(df)
+
+def run_calc(sliceDF, clones=None):    
+    if clones is None:
+        clones = report_clone_ids(sliceDF)
+    cloneCounts = np.bincount(clones)
+    cloneCounts = cloneCounts[cloneCounts > 0].tolist()
     vals = collections.OrderedDict({
         "total_umi_families" : sliceDF.shape[0],        
         "UMI_family_size" : sliceDF["UMI_family_size"].iloc[-1],
         "cummulative_reads" : sliceDF["cummulative_reads"].iloc[-1],
         "cummulative_fraction" : sliceDF["cummulative_fraction"].iloc[-1],
-        "unique_cdr3": len(sliceCDR3), 
-        "simpsons_diversity_index": simpsons_diversity_index(sliceCDR3.values()),
-        "simpsons_dominance_index": simpsons_dominance_index(sliceCDR3.values()),
-        "renyi_0": renyi_entropy(sliceCDR3.values(), alpha=0),
-        "renyi_1": renyi_entropy(sliceCDR3.values(), alpha=1),
-        "renyi_2": renyi_entropy(sliceCDR3.values(), alpha=2),
-        "renyi_inf": renyi_entropy(list(sliceCDR3.values()), alpha='inf'),
-        "renyi_0_norm": renyi_entropy(sliceCDR3.values(), alpha=0, normalize = True),
-        "renyi_1_norm": renyi_entropy(sliceCDR3.values(), alpha=1, normalize = True),
-        "renyi_2_norm": renyi_entropy(sliceCDR3.values(), alpha=2, normalize = True),
-        "renyi_inf_norm": renyi_entropy(list(sliceCDR3.values()), alpha='inf', normalize = True),
-        "D50": calc_D50(sliceCDR3.values())
+        "unique_cdr3": len(cloneCounts), 
+        "simpsons_diversity_index": simpsons_diversity_index(cloneCounts),
+        "simpsons_dominance_index": simpsons_dominance_index(cloneCounts),
+        "renyi_0": renyi_entropy(cloneCounts, alpha=0),
+        "renyi_1": renyi_entropy(cloneCounts, alpha=1),
+        "renyi_2": renyi_entropy(cloneCounts, alpha=2),
+        "renyi_inf": renyi_entropy(cloneCounts, alpha='inf'),
+        "renyi_0_norm": renyi_entropy(cloneCounts, alpha=0, normalize = True),
+        "renyi_1_norm": renyi_entropy(cloneCounts, alpha=1, normalize = True),
+        "renyi_2_norm": renyi_entropy(cloneCounts, alpha=2, normalize = True),
+        "renyi_inf_norm": renyi_entropy(cloneCounts, alpha='inf', normalize = True),
+        "D50": calc_D50(cloneCounts)
     })
     return vals
     
     
-def diversity_stats(df):
+def diversity_curve(clones, checkpoints):
     """
-    given a pandas data frame, calculate diversity/entropy stats one UMI family at a time.
+    Calculate diversity/entropy stats for prefixes of a list of clones, walking the list once.
+    Clone counts are kept sorted, with the sum of squared counts, the sum of c * log2(c) and the number of
+    top clones holding half of the UMI families updated as each UMI family is added.
+
+    Parameters
+    ----------
+    clones : list
+    integer clone id of each UMI family, in report order
+    checkpoints : list
+    prefix lengths (number of UMI families) to report
+
+    Returns
+    -------
+    stats : list
+    a dictionary of stats for each checkpoint, as returned by run_calc
     """
+    cloneCounts = [0] * (max(clones) + 1 if len(clones) else 0)
+    ##clone counts in descending order and the first position of each count
+    sortedCounts = []
+    countStart = {}
+    sumSquares = 0
+    sumCLogC = 0.0
+    maxCount = 0
+    ##number of top clones holding half of the UMI families, and their total
+    top = 0
+    topTotal = 0
+    checkpoints = sorted(set(checkpoints))
     stats = []
+    nextCheck = 0
+    for total, clone in enumerate(clones, 1):
+        if nextCheck == len(checkpoints):
+            break
+        count = cloneCounts[clone]
+        ##the clone moves to the front of its count
+        if count == 0:
+            pos = len(sortedCounts)
+            sortedCounts.append(1)
+        else:
+            pos = countStart[count]
+            sortedCounts[pos] = count + 1
+            if pos + 1 < len(sortedCounts) and sortedCounts[pos + 1] == count:
+                countStart[count] = pos + 1
+            else:
+                del countStart[count]
+        if not count + 1 in countStart:
+            countStart[count + 1] = pos
+        cloneCounts[clone] = count + 1
+        sumSquares += 2 * count + 1
+        sumCLogC += (count + 1) * math.log2(count + 1) - (count * math.log2(count) if count else 0)
+        maxCount = max(maxCount, count + 1)
+        ## D50
+        if pos < top:
+            topTotal += 1
+        while 2 * topTotal < total:
+            topTotal += sortedCounts[top]
+            top += 1
+        while top > 1 and 2 * (topTotal - sortedCounts[top - 1]) >= total:
+            top -= 1
+            topTotal -= sortedCounts[top]
+        if total < checkpoints[nextCheck]:
+            continue
+        nextCheck += 1
+        unique = len(sortedCounts)
+        norm = math.log2(unique) if unique > 1 else 1
+        shannon = math.log2(total) - sumCLogC / total
+        collision = -math.log2(sumSquares / (total * total))
+        minEntropy = math.log2(maxCount)
+        stats.append(collections.OrderedDict({
+            "total_umi_families" : total,
+            "unique_cdr3": unique,
+            "simpsons_diversity_index": 1 - (sumSquares - total) / (total * (total - 1)) if total > 1 else 0,
+            "simpsons_dominance_index": sumSquares / (total * total),
+            ## renyi_entropy returns None for alpha=0
+            "renyi_0": None,
+            "renyi_1": shannon,
+            "renyi_2": collision,
+            "renyi_inf": minEntropy,
+            "renyi_0_norm": None,
+            "renyi_1_norm": shannon / norm,
+            "renyi_2_norm": collision / norm,
+            "renyi_inf_norm": minEntropy / norm,
+            "D50": float(top / unique)
+        }))
+    return stats
+
+def diversity_steps(total):
+    """
+    Number of UMI families added between reported stats, fewer stats are reported for larger datasets
+    """
     ##no need to do all rows, slow with larger datasets
-    if df.shape[0] >= 100000:
-        for i in range(5000,df.shape[0],5000):
-            sliceDF = df[:i]        
-            vals = run_calc(sliceDF)
-            stats.append(vals)            
-    elif df.shape[0] >= 50000:
-        for i in range(1000,df.shape[0],1000):
-            sliceDF = df[:i]        
-            vals = run_calc(sliceDF)
-            stats.append(vals)
-    elif df.shape[0] >= 10000:
-        for i in range(500,df.shape[0],500):
-            sliceDF = df[:i]        
-            vals = run_calc(sliceDF)
-            stats.append(vals)
-    elif df.shape[0] >= 5000:
-        for i in range(100,df.shape[0],100):
-            sliceDF = df[:i]        
-            vals = run_calc(sliceDF)
-            stats.append(vals)
-    elif df.shape[0] >= 1000:
-        for i in range(20,df.shape[0],20):
-            sliceDF = df[:i]        
-            vals = run_calc(sliceDF)
-            stats.append(vals)
-    elif df.shape[0] >= 500:
-        for i in range(10,df.shape[0],10):
-            sliceDF = df[:i]        
-            vals = run_calc(sliceDF)
-            stats.append(vals)
-    elif df.shape[0] >= 100:
-        for i in range(2,df.shape[0],2):
-            sliceDF = df[:i]        
-            vals = run_calc(sliceDF)
-            stats.append(vals)
-    else:
-        for i in range(1,df.shape[0]):
-            sliceDF = df[:i]        
-            vals = run_calc(sliceDF)
-            stats.append(vals)
+    for minRows, step in ((100000, 5000), (50000, 1000), (10000, 500), (5000, 100),
+                          (1000, 20), (500, 10), (100, 2)):
+        if total >= minRows:
+            return step
+    return 1
+
+def diversity_stats(df, step=None):
+    """
+    given a pandas data frame, calculate diversity/entropy stats one UMI family at a time.
+
+    Parameters
+    ----------
+    df : pandas dataframe
+    cdr3 dedup report, ordered by UMI family. Clone ids are taken from the clone_id column if present
+    step : int
+    number of UMI families between reported stats, chosen from the size of df if None
+    """
+    if step is None:
+        step = diversity_steps(df.shape[0])
+    checkpoints = list(range(step, df.shape[0], step))
+    clones = report_clone_ids(df).tolist()
+    stats = []
+    for vals in diversity_curve(clones, checkpoints):
+        i = vals["total_umi_families"]
+        stats.append(collections.OrderedDict({
+            "total_umi_families" : i,
+            "UMI_family_size" : df["UMI_family_size"].iloc[i - 1],
+            "cummulative_reads" : df["cummulative_reads"].iloc[i - 1],
+            "cummulative_fraction" : df["cummulative_fraction"].iloc[i - 1],
+            **{x: vals[x] for x in vals if x != "total_umi_families"}
+        }))
     summaryDF = pandas.DataFrame(stats)            
     return summaryDF
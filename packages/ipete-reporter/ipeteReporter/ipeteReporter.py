@@ -43,7 +43,7 @@ def ipete_reporter(dedupFile, params, basename):
         ###################################
         ## cluster CDR3 based on sequences
         ###################################
-        graph = SeqNetwork.SeqNetwork()
+        graph = SeqNetwork.SeqNetwork(processors=params.get("processors", 1))
         for UID, cdr3_AA in zip(df["UMI_group"], df["cdr3_AA"]):
             graph.add_dimension("cdr3_AA", UID, cdr3_AA, params["cdr3_dist"])
         graph.build_graph()
@@ -51,8 +51,7 @@ def ipete_reporter(dedupFile, params, basename):
         ######################################
         ## define CDR3 AA similarity networks
         ######################################
-        networks = graph.collapse_graph()
-        network_labels = graph.retreive_read_labels(networks)
+        network_labels = pandas.Series(graph.read_family_labels(), index=graph.read_names)
         df["cdr3_network"] = df["UMI_group"].map(network_labels)
 
         ##remove edges from network based on dedup model, defining clusters
@@ -62,8 +61,7 @@ def ipete_reporter(dedupFile, params, basename):
         ########################
         ## define CDR3 clusters
         ########################
-        families = graph.collapse_graph()
-        family_labels = graph.retreive_read_labels(families)
+        family_labels = pandas.Series(graph.read_family_labels(), index=graph.read_names)
         df["cdr3_cluster"] = df["UMI_group"].map(family_labels)
 
     ########################
@@ -109,6 +107,8 @@ def ipete_reporter(dedupFile, params, basename):
         cdr3Ids.append(cdr3Id)        
     df["chain"] = chainVals
     df["cdr3Id"] = cdr3Ids
+    ##integer clone id, reused by the diversity stats
+    df["clone_id"] = clone_ids(df)
        
     ###########################
     ## Collect Diversity stats
@@ -140,11 +140,17 @@ def main():
     parser.add_argument("-b", "--basename",
                         required=True,
                         help="output basename for report files")
+    parser.add_argument("-p", "--processors",
+                        required=False,
+                        type = int,
+                        default=1,
+                        help="number of processors used for cdr3 clustering")
     args = parser.parse_args()    
     params = {}
     params["cdr3_dist"] = args.cdr3_dist
     params["max_steps"] = args.max_steps
     params["bidding_ratio"] = args.bidding_ratio
+    params["processors"] = args.processors
     ipete_reporter(args.cdr3_report, params, args.basename)
 
 if __name__ == '__main__':
@@ -1,6 +1,7 @@
 import pandas
 import argparse
 import pysam
+import multiprocessing
 from FastqStreamer.FastqReader import FastqReader
 from BamStreamer.BamUtils import read_alignments
 
@@ -17,8 +18,9 @@ class IPeteSpikeIn(FastqReader):
     Dictionary for counting spike-in alignments
     """
 
-    def __init__(self, spikein, reference_annot_file, basename):
+    def __init__(self, spikein, reference_annot_file, basename, threads=1):
         FastqReader.__init__(self)
+        self.threads = threads
         self.spikes = self.load_spike_aln(spikein)
         self.spike_stats = {}
         self.basename = basename
@@ -39,7 +41,7 @@ class IPeteSpikeIn(FastqReader):
 
         """
         spikes = {}
-        for read in read_alignments(spikeBam):
+        for read in read_alignments(spikeBam, fields=['reference_name'], threads=self.threads):
             read_name = read["query_name"]
             spikes[read_name] = read['reference_name']
         return spikes
@@ -56,30 +58,21 @@ class IPeteSpikeIn(FastqReader):
         Jgene alignments bam file
         """
 
-        Vsam = pysam.AlignmentFile(Vbam, "rb", check_sq=False)
-        nativeV = pysam.AlignmentFile("{}_Vgene_native.bam".format(self.basename), "wb", template=Vsam)        
-        spikeV = pysam.AlignmentFile("{}_Vgene_spikein.bam".format(self.basename), "wb", template=Vsam)        
-        Vsam.close()
-        ##split V gene alignments reads based on spikein alignments
-        for read in read_alignments(Vbam):
-            if read["query_name"] in self.spikes:
-                spikeV.write(read['pyread'])
-            else:
-                nativeV.write(read['pyread'])                
-        nativeV.close()
-        spikeV.close()                
-        Jsam = pysam.AlignmentFile(Jbam, "rb", check_sq=False)
-        nativeJ = pysam.AlignmentFile("{}_Jgene_native.bam".format(self.basename), "wb", template=Jsam)        
-        spikeJ = pysam.AlignmentFile("{}_Jgene_spikein.bam".format(self.basename), "wb", template=Jsam)        
-        Jsam.close()
-        ##split J gene alignments reads based on spikein alignments
-        for read in read_alignments(Jbam):
-            if read["query_name"] in self.spikes:
-                spikeJ.write(read['pyread'])
-            else:
-                nativeJ.write(read['pyread'])                
-        nativeJ.close()
-        spikeJ.close()
+        if self.threads <= 1:
+            self.split_bam(Vbam, "Vgene")
+            self.split_bam(Jbam, "Jgene")
+            return
+        ##split V and J alignments concurrently, forked processes share the spike-in read names
+        threads = max(self.threads // 2, 1)
+        context = multiprocessing.get_context("fork")
+        workers = [context.Process(target=self.split_bam, args=(bam, gene, threads))
+                   for bam, gene in ((Vbam, "Vgene"), (Jbam, "Jgene"))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if any(worker.exitcode != 0 for worker in workers):
+            raise RuntimeError("splitting V/J alignments failed")
 
         ###################################################################################
         ##can also process with BamLinker, but is slower with larger files, because of I/O
@@ -115,7 +108,32 @@ class IPeteSpikeIn(FastqReader):
         # nativeJ.close()        
         # spikeJ.close()
         # Jsam.close()
-        
+
+    def split_bam(self, bam, gene, threads=1):
+        """
+        split one gene alignment bam file into spike-in and native read files,
+        {basename}_{gene}_spikein.bam and {basename}_{gene}_native.bam
+
+        bam : str
+        gene alignments bam file
+        gene : str
+        gene name used in the output file names ("Vgene" or "Jgene")
+        threads : int
+        number of threads used for BGZF (de)compression of each bam file
+        """
+        sam = pysam.AlignmentFile(bam, "rb", check_sq=False)
+        native = pysam.AlignmentFile("{}_{}_native.bam".format(self.basename, gene), "wb", template=sam, threads=threads)
+        spike = pysam.AlignmentFile("{}_{}_spikein.bam".format(self.basename, gene), "wb", template=sam, threads=threads)
+        sam.close()
+        ##split gene alignments reads based on spikein alignments
+        for read in read_alignments(bam, fields=['pyread'], threads=threads):
+            if read["query_name"] in self.spikes:
+                spike.write(read['pyread'])
+            else:
+                native.write(read['pyread'])
+        native.close()
+        spike.close()
+
     def report_spikein_counts(self, VJaln, outFile):
         """
         write a report file of spike-in sequences
@@ -202,12 +220,17 @@ def main():
     parser.add_argument("-b", "--basename",
                         required=True,
                         help="basename argument for report file name")
+    parser.add_argument("-t", "--threads",
+                        type=int,
+                        required=False,
+                        default=1,
+                        help="number of threads, V and J alignments are split concurrently when > 1")
     args = parser.parse_args()
     if args.action == "count":
         if args.VJaln is None:
             parser.error("VJ alignments are required is action = count")
 
-    spikeinParser = IPeteSpikeIn(args.spike_aln, args.reference_annot, args.basename)
+    spikeinParser = IPeteSpikeIn(args.spike_aln, args.reference_annot, args.basename, args.threads)
     if args.action == "split":
         spikeinParser.split_bams(args.v_aln, args.j_aln)
     elif args.action == "count":
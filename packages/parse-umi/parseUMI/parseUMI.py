@@ -1,8 +1,95 @@
 import pandas
 import argparse
-from FastqStreamer.FastqReader import FastqReader
+import collections
+import itertools
+import multiprocessing
+from FastqStreamer.FastqReader import FastqReader, open_fastq
 import os
 
+"""
+Read pairs are labeled in chunks: each chunk is formatted into one block of fastq text per
+read file, optionally in worker processes, and written with a single call per file.
+"""
+
+## quality character -> "Q," lookup, applied with str.translate instead of ord() per base
+QUAL_TABLE = str.maketrans({chr(i): "{},".format(i - 33) for i in range(256)})
+## compact labels keep one character per quality: the printable characters '!'-'~' without
+## ':' (label delimiter), '@' (not allowed in SAM read names) and '_' (field delimiter).
+## Q0-Q24 match Phred+33, the encoding is order preserving and covers Q0-Q90.
+COMPACT_QUALS = "".join(chr(c) for c in range(33, 127) if not chr(c) in ":@_")
+COMPACT_TABLE = str.maketrans({chr(i): COMPACT_QUALS[min(max(i - 33, 0), len(COMPACT_QUALS) - 1)]
+                               for i in range(256)})
+COMPACT_SUFFIX = "_c"
+CHUNK_SIZE = 100000
+
+
+def umi_label(seq, qual, umi_pattern, UMI_id, compact=False):
+    """
+    Format the UMI label for one read, ':UMI_id__seq__qual', or ':UMI_id_c__seq__qual'
+    with one quality character per base when compact
+
+    Parameters
+    ----------
+    seq : str
+    read sequence
+    qual : str
+    read quality string
+    umi_pattern : tuple
+    coordinates of the UMI in the read
+    UMI_id : str
+    A name for the UMI being parsed
+    compact : bool
+    encode qualities with COMPACT_QUALS instead of comma separated integers
+
+    Returns
+    -------
+    label : str
+    the label appended to the read name, empty if there is no UMI pattern
+    """
+    if umi_pattern == (0,0):
+        return ""
+    start, end = umi_pattern[0], umi_pattern[1] + 1
+    if compact:
+        return ":{}{}__{}__{}".format(UMI_id, COMPACT_SUFFIX, seq[start:end],
+                                      qual[start:end].translate(COMPACT_TABLE))
+    return ":{}__{}__{}".format(UMI_id, seq[start:end],
+                                qual[start:end].translate(QUAL_TABLE)[:-1])
+
+
+def label_chunk(chunk, r1_umi, r2_umi, compact=False):
+    """
+    Label a chunk of read pairs with their UMIs
+
+    Parameters
+    ----------
+    chunk : list
+    tuples of raw fastq lines (name1, seq1, qual1, seq2, qual2)
+    r1_umi : tuple
+    coordinates of the UMI in read1
+    r2_umi : tuple
+    coordinates of the UMI in read2
+    compact : bool
+    write compact UMI labels
+
+    Returns
+    -------
+    (read1 text, read2 text) : tuple of str
+    fastq formatted records for the chunk
+    """
+    out1 = []
+    out2 = []
+    for name1, seq1, qual1, seq2, qual2 in chunk:
+        seq1 = seq1.rstrip("\n")
+        qual1 = qual1.rstrip("\n")
+        seq2 = seq2.rstrip("\n")
+        qual2 = qual2.rstrip("\n")
+        read_name = "{}{}{}".format(name1.rstrip("\n").replace("@", "").split(" ")[0],
+                                    umi_label(seq1, qual1, r1_umi, "UMI_R1", compact),
+                                    umi_label(seq2, qual2, r2_umi, "UMI_R2", compact))
+        out1.append("@{}\n{}\n+\n{}\n".format(read_name, seq1, qual1))
+        out2.append("@{}\n{}\n+\n{}\n".format(read_name, seq2, qual2))
+    return "".join(out1), "".join(out2)
+
 
 class UmiParser(FastqReader):
     """Parse UID sequences using patterns for Read1 and/or Read2 sequences.
@@ -14,14 +101,26 @@ class UmiParser(FastqReader):
     
     """
 
-    def __init__(self, read1_pattern, read2_pattern):
+    def __init__(self, read1_pattern, read2_pattern, threads=1, chunk_size=CHUNK_SIZE,
+                 compact=False):
         """
         Parameters
         ----------
-        uid_length : int
-        Set the uid size, first X bases of read2 define the UMI
+        read1_pattern : str
+        UMI pattern for read1
+        read2_pattern : str
+        UMI pattern for read2
+        threads : int
+        number of worker processes labeling chunks (1 labels in the main process)
+        chunk_size : int
+        number of read pairs labeled and written at once
+        compact : bool
+        label reads with one quality character per UMI base instead of comma separated integers
         """
-        FastqReader.__init__(self)
+        FastqReader.__init__(self, io_threads=1 if threads > 1 else 0)
+        self.compact = compact
+        self.threads = threads
+        self.chunk_size = chunk_size
         self.r1_umi = self.get_umi_pattern(read1_pattern)
         self.r2_umi = self.get_umi_pattern(read2_pattern)
         
@@ -54,8 +153,8 @@ class UmiParser(FastqReader):
         
         Parameters
         ----------
-        read : dict
-        A dictionary of read elements returned by FastqReader
+        read : FastqRecord
+        A read record returned by FastqReader
         umi_pattern : tuple
         coordinates of the UMI in the read
         read_name : str
@@ -70,20 +169,64 @@ class UmiParser(FastqReader):
         """    
         ##cut the UMI from the read seq and quality string.
         ## the second coordinate +1 for capturing the last position
-        if umi_pattern == (0,0):
-            return read_name             
-        UID = read["seq"][umi_pattern[0]:(umi_pattern[1]+1)]
-        UID_qual = read["qual"][umi_pattern[0]:(umi_pattern[1]+1)]
-        qualVals = []
-        for char in UID_qual:
-            qualVals.append(ord(char)-33)
-        qualString = ",".join([str(x) for x in qualVals])
-        ##reformat read name
-        newName = "{name}:{UMI_id}__{seq}__{qual}".format(name=read_name,
-                                                        UMI_id = UMI_id,
-                                                        seq = UID,
-                                                        qual = qualString)
-        return newName
+        return read_name + umi_label(read.seq, read.qual, umi_pattern, UMI_id, self.compact)
+
+    def iter_raw_chunks(self, fq1, fq2):
+        """
+        An iterator, returning chunks of unparsed read pairs
+
+        Parameters
+        ----------
+        fq1 : path
+        path to read1 fastq file
+        fq2 : path
+        path to read2 fastq file
+
+        Returns
+        -------
+        chunk : list of tuples (name1, seq1, qual1, seq2, qual2), lines as read from the files
+        """
+        with open_fastq(fq1, self.io_threads_) as fh1, \
+             open_fastq(fq2, self.io_threads_) as fh2:
+            pairs = ((name1, seq1, qual1, seq2, qual2)
+                     for (name1, seq1, _, qual1), (_, seq2, _, qual2)
+                     in zip(zip(fh1, fh1, fh1, fh1), zip(fh2, fh2, fh2, fh2)))
+            while True:
+                chunk = list(itertools.islice(pairs, self.chunk_size))
+                if not chunk:
+                    break
+                yield chunk
+
+    def iter_labeled_chunks(self, fq1, fq2):
+        """
+        An iterator, returning labeled fastq text for each chunk, in input order
+
+        Parameters
+        ----------
+        fq1 : path
+        path to read1 fastq file
+        fq2 : path
+        path to read2 fastq file
+
+        Returns
+        -------
+        (read1 text, read2 text) : tuple of str
+        """
+        chunks = self.iter_raw_chunks(fq1, fq2)
+        if self.threads <= 1:
+            for chunk in chunks:
+                yield label_chunk(chunk, self.r1_umi, self.r2_umi, self.compact)
+            return
+        ## bound the chunks in flight, Pool.imap would read the whole input ahead
+        with multiprocessing.Pool(self.threads) as pool:
+            pending = collections.deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(label_chunk,
+                                                (chunk, self.r1_umi, self.r2_umi, self.compact)))
+                if len(pending) >= self.threads * 2:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
         
     def label_umi(self, fq1, fq2):
         """Add UID to read1 and read2 headers. write a fastq file with "_uid.fastq" extension.
@@ -99,18 +242,11 @@ class UmiParser(FastqReader):
         -------
         None
         """
-        read_pairs = []
-        out1 = self.create_fastq_handle(os.path.basename(fq1).replace(".fastq", "_uid.fastq"))
-        out2 = self.create_fastq_handle(os.path.basename(fq2).replace(".fastq", "_uid.fastq"))
-        for read_pair in self.iter_pairs(fq1, fq2):
-            # Ipete UID starts read2
-            read_name = read_pair["read1"]["read_name"]
-            read_name = self.read_umi_label(read_pair["read1"], self.r1_umi, read_name, "UMI_R1")
-            read_name = self.read_umi_label(read_pair["read2"], self.r2_umi, read_name, "UMI_R2")
-            read_pair["read1"]["read_name"] = read_name
-            read_pair["read2"]["read_name"] = read_name
-            self.write_fastq(read_pair["read1"], out1)
-            self.write_fastq(read_pair["read2"], out2)
+        out1 = self.open_output(os.path.basename(fq1).replace(".fastq", "_uid.fastq"))
+        out2 = self.open_output(os.path.basename(fq2).replace(".fastq", "_uid.fastq"))
+        for text1, text2 in self.iter_labeled_chunks(fq1, fq2):
+            out1.write(text1)
+            out2.write(text2)
         self.close_file_handles()
 
 def main():
@@ -132,10 +268,24 @@ def main():
                         required=False,
                         default = "",
                         help="UMI Pattern for Read 2. for example NNNNNNNNNNNN (X = nonUMI base, N=UMI bases)")
+    parser.add_argument("-t", "--threads",
+                        type=int,
+                        required=False,
+                        default=1,
+                        help="number of worker processes labeling chunks of reads")
+    parser.add_argument("-c", "--chunk_size",
+                        type=int,
+                        required=False,
+                        default=CHUNK_SIZE,
+                        help="number of read pairs labeled and written at once")
+    parser.add_argument("--compact",
+                        action="store_true",
+                        help="store UMI qualities as one character per base (UMI_R1_c__SEQ__QUAL), read natively by extract-umi")
     args = parser.parse_args()
     if args.umi_read1 == "" and args.umi_read2 == "":
         parser.error("A UMI pattern for read1 and/or read2 is required")
-    instance = UmiParser(args.umi_read1, args.umi_read2)
+    instance = UmiParser(args.umi_read1, args.umi_read2, args.threads, args.chunk_size,
+                         args.compact)
     instance.label_umi(args.read1, args.read2)
 
 
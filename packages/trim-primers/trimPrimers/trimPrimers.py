@@ -12,16 +12,21 @@ class IPetePrimerTrimmer(FastqReader):
     Parse primer alignments from reads, trim primers from ends
     """
 
-    def __init__(self, primer_info, expected_v_start):
+    def __init__(self, primer_info, expected_v_start, compress=False, io_threads=0):
         """
         Parameters
         ----------
         reference_annot_file : Str
         reference annotation format for primer sequences
+        compress : bool
+        write BGZF compressed fastq files (.fastq.gz)
+        io_threads : int
+        number of threads used for compressing output and reading bam files
 
         """
-        FastqReader.__init__(self)
+        FastqReader.__init__(self, io_threads)
         self.expected_v_start = expected_v_start
+        self.fastq_ext = ".fastq.gz" if compress else ".fastq"
         self.reference = import_primer_reference(primer_info)
         
     def get_aln_stats(self, read, whichGene):
@@ -116,10 +121,8 @@ class IPetePrimerTrimmer(FastqReader):
         """
         header = "name\tv_gene\tv_start\tv_end\tv_qStart\tv_qEnd\tv_score\tv_cigar\tv_mismatch\tv_insertion\tv_deletion\tv_percent_id\tv_alnType\tv_primer_len\tj_gene\tj_start\tj_end\tj_qStart\tj_qEnd\tj_score\tj_cigar\tj_mismatch\tj_insertion\tj_deletion\tj_percent_id\tj_alnType\tj_primer_len\tavg_read_qual\n"
         if not filename in self.file_handles_:
-            fh = open(filename, 'w')
-            self.file_handles_[filename] = fh
+            fh = self.open_output(filename)
             fh.write(header)
-        fh = self.file_handles_[filename]
         return filename
 
     def trim_alignments(self, read, whichGene):
@@ -196,14 +199,15 @@ class IPetePrimerTrimmer(FastqReader):
         #######################
         ## create file handles
         #######################
-        trim_reads = self.create_fastq_handle("{}_trim_primers.fastq".format(basename))
-        too_short = self.create_fastq_handle("{}_too_short.fastq".format(basename))
+        trim_reads = self.create_fastq_handle("{}_trim_primers{}".format(basename, self.fastq_ext))
+        too_short = self.create_fastq_handle("{}_too_short{}".format(basename, self.fastq_ext))
         primer_hits = self.create_stats_handle("{}_trim_primers.tsv".format(basename))
         short_hits = self.create_stats_handle("{}_too_short.tsv".format(basename))
         #############################
         # filter reads by alignment
         #############################        
-        for read in read_two_bams(vbam, "vgene", jbam, "jgene"):            
+        for read in read_two_bams(vbam, "vgene", jbam, "jgene",
+                                  threads=max(self.io_threads_, 1)):            
             read["trim_seq"] = read["seq"]
             read["trim_qual"] = read["qual"]            
             # both V and J align
@@ -240,8 +244,18 @@ def main():
     parser.add_argument("-j", "--j_aln",
                         required=True,
                         help="J probe alignment bam file")
+    parser.add_argument("-z", "--compress",
+                        required=False,
+                        action='store_true',
+                        default=False,
+                        help="write BGZF compressed fastq files (.fastq.gz)")
+    parser.add_argument("-t", "--threads",
+                        required=False,
+                        type=int,
+                        default=0,
+                        help="number of threads used for compressing output and reading bam files")
     args = parser.parse_args()
-    trimmer = IPetePrimerTrimmer(args.primer_info, 14)
+    trimmer = IPetePrimerTrimmer(args.primer_info, 14, args.compress, args.threads)
     trimmer.trim_primers(args.v_aln, args.j_aln, args.basename)
 
 if __name__ == '__main__':    
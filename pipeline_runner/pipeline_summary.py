@@ -5,6 +5,7 @@ import re
 import collections
 import math
 from ipeteMetrics.utils import *
+from ipeteMetrics import diversity
 
 
 def match_files(path, pattern):
@@ -26,35 +27,53 @@ def match_files(path, pattern):
     files = os.listdir(path)
     return ["{}/{}".format(path,x) for x in files if re.search(pattern, x)]
 
-def summarizeChain(df, chain):
-    chainTab = df.loc[df["chain"] == chain]
-    cloneCounts = []
-    for cdr3nt, df in chainTab.groupby(["cdr3Id"]):
-        cloneCounts.append(df.shape[0])
-    ##return deversity metrics if we have at least 50 cdr3 
-    if(sum(cloneCounts) > 10):
-        D50 = calc_D50(cloneCounts) ##/ sum(cloneCounts)
-        stats = collections.OrderedDict({        
-            "{}_renyi_1_norm".format(chain) : renyi_entropy(cloneCounts, alpha=1, normalize=True),
-            "{}_renyi_2_norm".format(chain) : renyi_entropy(cloneCounts, alpha=2, normalize=True),
-            "{}_simpsons_diversity_norm".format(chain) : simpsons_diversity_index(cloneCounts),
-            "{}_simpsons_dominance_norm".format(chain) : simpsons_dominance_index(cloneCounts),        
-            "{}_unique_cdr3".format(chain) : len(cloneCounts),
-            "{}_D50".format(chain) : D50,
-            "{}_gini_index".format(chain) : gini(cloneCounts),
-            "{}_cdr3_clusters".format(chain) : len(set(chainTab["cdr3_cluster"]))
-        })
-    else:
-        stats = collections.OrderedDict({        
-            "{}_renyi_1_norm".format(chain) : None,
-            "{}_renyi_2_norm".format(chain) : None,
-            "{}_simpsons_diversity_norm".format(chain) : None,
-            "{}_simpsons_dominance_norm".format(chain) : None,        
-            "{}_unique_cdr3".format(chain) : len(cloneCounts),
-            "{}_D50".format(chain) : None,
-            "{}_gini_index".format(chain) : None,
-            "{}_cdr3_clusters".format(chain) : None
-        })
+def summarizeChains(df, chains):
+    """
+    diversity metrics of each chain, the clone counts of chains with more than 10 UMI families are scored together
+
+    Parameters
+    ----------
+    df : pandas dataframe
+        functional cdr3 report
+    chains : list
+        chain names, in report order
+
+    Returns
+    -------
+    OrderedDict of stats for all chains
+    """
+    chainTabs = [df.loc[df["chain"] == chain] for chain in chains]
+    ##count UMI families per integer clone id (same clones as cdr3Id)
+    cloneCounts = [pandas.Series(report_clone_ids(chainTab)).value_counts().values for chainTab in chainTabs]
+    ##return deversity metrics if we have at least 50 cdr3, only those chains are scored
+    scored = [i for i in range(len(chains)) if cloneCounts[i].sum() > 10]
+    if scored:
+        indices = diversity.diversity_indices(diversity.count_matrix([cloneCounts[i] for i in scored]), orders=(1, 2))
+    stats = collections.OrderedDict()
+    for i, chain in enumerate(chains):
+        if i in scored:
+            row = scored.index(i)
+            stats.update(collections.OrderedDict({        
+                "{}_renyi_1_norm".format(chain) : indices["renyi_1_norm"][row],
+                "{}_renyi_2_norm".format(chain) : indices["renyi_2_norm"][row],
+                "{}_simpsons_diversity_norm".format(chain) : indices["simpsons_diversity_index"][row],
+                "{}_simpsons_dominance_norm".format(chain) : indices["simpsons_dominance_index"][row],        
+                "{}_unique_cdr3".format(chain) : len(cloneCounts[i]),
+                "{}_D50".format(chain) : indices["D50"][row],
+                "{}_gini_index".format(chain) : indices["gini_index"][row],
+                "{}_cdr3_clusters".format(chain) : len(set(chainTabs[i]["cdr3_cluster"]))
+            }))
+        else:
+            stats.update(collections.OrderedDict({        
+                "{}_renyi_1_norm".format(chain) : None,
+                "{}_renyi_2_norm".format(chain) : None,
+                "{}_simpsons_diversity_norm".format(chain) : None,
+                "{}_simpsons_dominance_norm".format(chain) : None,        
+                "{}_unique_cdr3".format(chain) : len(cloneCounts[i]),
+                "{}_D50".format(chain) : None,
+                "{}_gini_index".format(chain) : None,
+                "{}_cdr3_clusters".format(chain) : None
+            }))
     return stats
            
  
@@ -167,16 +186,10 @@ def pipeline_summary(analysisDir, outFile):
         #diversityVals = diversityStats.tail(1)
         #diversityVals = diversityVals.reset_index()
         ## summarize chain
-        cloneCounts = {}
-        for chain, cdr3Id in zip(cdr3Stats["chain"], cdr3Stats["cdr3Id"]):
-            if not cdr3Id in cloneCounts:
-                cloneCounts[cdr3Id] = 0
-            cloneCounts[cdr3Id] += 1 
+        for chain in cdr3Stats["chain"]:
             chains[chain]+=1
         ## diversity stats calculated by chain
-        ighStats = summarizeChain(cdr3Stats, "IGH")
-        trbStats = summarizeChain(cdr3Stats, "TRB")
-        trdStats = summarizeChain(cdr3Stats, "TRD")
+        chainStats = summarizeChains(cdr3Stats, ["TRB", "IGH", "TRD"])
         cellCount = chains["TRB"] + chains["TRD"] + chains["IGH"]
         ## Pass or fail the sample
         status = "pass"
@@ -209,7 +222,7 @@ def pipeline_summary(analysisDir, outFile):
             TRB_percent = chains["TRB"]/sum(chains.values())
             TRD_percent = chains["TRD"]/sum(chains.values())        
         ## summarize sample
-        CDR3clones = cdr3Stats["cdr3Id"].value_counts().to_dict()
+        CDR3clones = pandas.Series(report_clone_ids(cdr3Stats)).value_counts().to_dict()
         D50 = 0
         gini_index = None
         renyi1 = None
@@ -217,12 +230,13 @@ def pipeline_summary(analysisDir, outFile):
         simpsonsDiv = None
         simpsonsDom = None
         if sum(CDR3clones.values()) > 0:            
-            D50 = calc_D50(CDR3clones.values())
-            gini_index =  gini(list(cloneCounts.values()))
-            renyi1 = "{:.6f}".format(renyi_entropy(list(CDR3clones.values()), alpha=1, normalize=True))
-            renyi2 = "{:.6f}".format(renyi_entropy(list(CDR3clones.values()), alpha=2, normalize=True))
-            simpsonsDiv =  "{:.6f}".format(simpsons_diversity_index(CDR3clones.values()))
-            simpsonsDom = "{:.6f}".format(simpsons_dominance_index(CDR3clones.values()))
+            indices = diversity.diversity_indices(list(CDR3clones.values()), orders=(1, 2))
+            D50 = indices["D50"]
+            gini_index = indices["gini_index"]
+            renyi1 = "{:.6f}".format(indices["renyi_1_norm"])
+            renyi2 = "{:.6f}".format(indices["renyi_2_norm"])
+            simpsonsDiv =  "{:.6f}".format(indices["simpsons_diversity_index"])
+            simpsonsDom = "{:.6f}".format(indices["simpsons_dominance_index"])
         if cellCount < 10:
             status = "fail: <10 cells"
         stats = collections.OrderedDict({
@@ -260,9 +274,7 @@ def pipeline_summary(analysisDir, outFile):
             "simpsons_diversity_index" : simpsonsDiv, ## "{:.6f}".format(simpsons_diversity_index(CDR3clones.values())),
             "simpsons_dominance_index" : simpsonsDom ##"{:.6f}".format(simpsons_dominance_index(CDR3clones.values()))
         })
-        stats.update(trbStats)
-        stats.update(ighStats)
-        stats.update(trdStats)        
+        stats.update(chainStats)
         reportFiles = collections.OrderedDict({
             "cdr3_report" : cdr3Report,
             "diversity_report" : divReport,
@@ -0,0 +1,19 @@
+#!/bin/bash -e
+
+## summarizeChains regression: an empty functional report, or one without TRB/IGH/TRD rows,
+## reports the all-None stats for every chain
+cd "$(dirname "$0")"
+
+python - <<'EOF'
+import io
+import pandas
+from pipeline_summary import summarizeChains
+
+header = "chain\tVgene\tcdr3\tJgene\tcdr3Id\tcdr3_cluster\n"
+traRows = "".join("TRA\tTRAV1\tC{0}\tTRAJ1\tTRAV1__C{0}__TRAJ1\t{0}\n".format(i % 4) for i in range(30))
+for report in (header, header + traRows):
+    stats = summarizeChains(pandas.read_csv(io.StringIO(report), sep="\t"), ["TRB", "IGH", "TRD"])
+    for name, val in stats.items():
+        assert val == (0 if name.endswith("_unique_cdr3") else None), (name, val)
+print("summarizeChains: ok")
+EOF